@@ -0,0 +1,159 @@
+"""
+Admission control cho các request tạo icon
+Mỗi request được ước lượng chi phí trước khi chạy; ngân sách chung, giới hạn đồng thời
+và rate limit theo client được giữ trong file JSON có khóa nên áp dụng cho mọi worker Gunicorn
+"""
+
+import os
+import math
+import time
+import uuid
+import logging
+
+from storage import JsonIndex, pid_alive
+
+logger = logging.getLogger(__name__)
+
+
+class Rejected(Exception):
+    """Request bị từ chối: status 429 (client vượt giới hạn) hoặc 503 (máy chủ hết ngân sách)"""
+
+    def __init__(self, message, status, retry_after, reason):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class AdmissionController:
+    """
+    Ngân sách chi phí dùng chung cho mọi worker.
+    - Request rẻ (cost <= cheap_cost) được dùng toàn bộ ngân sách, request nặng chỉ được dùng
+      phần còn lại sau khi trừ cheap_reserve, nên request nặng không chặn được request rẻ.
+    - Hết ngân sách thì request chờ tối đa queue_timeout giây rồi trả về 503.
+    - Mỗi client (remote_addr) bị giới hạn số request đồng thời và số request trong rate_window giây (429).
+    """
+
+    def __init__(self, directory, budget, client_concurrency=2, rate_limit=60, rate_window=60,
+                 cheap_cost=6, cheap_reserve=0.25, queue_timeout=10, ticket_ttl=600, poll_interval=0.05):
+        self.budget = budget
+        self.client_concurrency = client_concurrency
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.cheap_cost = cheap_cost
+        self.cheap_reserve = cheap_reserve
+        self.queue_timeout = queue_timeout
+        self.ticket_ttl = ticket_ttl
+        self.poll_interval = poll_interval
+        self.index = JsonIndex(os.path.join(directory, 'state.json'), default={
+            'tickets': {}, 'rates': {}, 'admitted': 0, 'queued': 0,
+            'rejected': {'rate': 0, 'concurrency': 0, 'budget': 0},
+        })
+
+    @property
+    def enabled(self):
+        return self.budget > 0
+
+    def admit(self, client, cost, timeout=None):
+        """
+        Chờ tối đa timeout giây (mặc định queue_timeout, 0 = không chờ) đến khi đủ ngân sách
+        và trả về ticket, raise Rejected nếu bị từ chối
+        """
+        if not self.enabled:
+            return None
+
+        deadline = time.monotonic() + (self.queue_timeout if timeout is None else timeout)
+        ticket = uuid.uuid4().hex[:16]
+        limit = self.budget if cost <= self.cheap_cost else self.budget * (1 - self.cheap_reserve)
+
+        while True:
+            # Không raise bên trong khóa: JsonIndex chỉ ghi lại state khi khối with kết thúc bình thường
+            with self.index.locked() as state:
+                rejected = self._try_admit(state, ticket, client, cost, limit, deadline)
+            if rejected is None:
+                return ticket
+            if rejected is not True:
+                raise rejected
+            time.sleep(self.poll_interval)
+
+    def _try_admit(self, state, ticket, client, cost, limit, deadline):
+        """None = được nhận, True = tiếp tục chờ, Rejected = bị từ chối"""
+        now = time.time()
+        tickets = state['tickets']
+        self._purge(state, now)
+
+        if ticket not in tickets:
+            rejected = self._check_client(state, client, now)
+            if rejected is not None:
+                return rejected
+            tickets[ticket] = {'client': client, 'cost': cost, 'pid': os.getpid(),
+                               'started': now, 'waiting': False}
+
+        inflight = sum(t['cost'] for key, t in tickets.items() if not t['waiting'] and key != ticket)
+        running = any(not t['waiting'] for key, t in tickets.items() if key != ticket)
+        # Request lớn hơn cả ngân sách vẫn được chạy khi máy chủ rảnh, nếu không sẽ không bao giờ chạy được
+        if inflight + cost <= limit or not running:
+            if tickets[ticket]['waiting']:
+                state['queued'] += 1
+            tickets[ticket].update({'waiting': False, 'started': now})
+            state['admitted'] += 1
+            return None
+
+        if time.monotonic() >= deadline:
+            if tickets.pop(ticket)['waiting']:
+                state['queued'] += 1
+            state['rejected']['budget'] += 1
+            return Rejected('Máy chủ đang quá tải, vui lòng thử lại sau', 503,
+                            max(1, math.ceil(self.queue_timeout)), 'budget')
+
+        tickets[ticket]['waiting'] = True
+        return True
+
+    def release(self, ticket):
+        """Trả lại ngân sách khi request / job kết thúc"""
+        if ticket is None:
+            return
+        with self.index.locked() as state:
+            state['tickets'].pop(ticket, None)
+
+    def stats(self):
+        """Số request được nhận / phải chờ / bị từ chối và ngân sách đang dùng"""
+        state = self.index.read()
+        running = [t for t in state['tickets'].values() if not t['waiting']]
+        return {
+            'enabled': self.enabled,
+            'budget': self.budget,
+            'inflight_cost': sum(t['cost'] for t in running),
+            'running': len(running),
+            'waiting': len(state['tickets']) - len(running),
+            'admitted': state['admitted'],
+            'queued': state['queued'],
+            'rejected': state['rejected'],
+        }
+
+    def _check_client(self, state, client, now):
+        timestamps = [t for t in state['rates'].get(client, []) if now - t < self.rate_window]
+        state['rates'][client] = timestamps
+        if self.rate_limit and len(timestamps) >= self.rate_limit:
+            state['rejected']['rate'] += 1
+            return Rejected('Quá nhiều request, vui lòng thử lại sau', 429,
+                            max(1, math.ceil(self.rate_window - (now - timestamps[0]))), 'rate')
+
+        active = sum(1 for t in state['tickets'].values() if t['client'] == client)
+        if self.client_concurrency and active >= self.client_concurrency:
+            state['rejected']['concurrency'] += 1
+            return Rejected('Đang có quá nhiều request cùng lúc từ địa chỉ này', 429, 1, 'concurrency')
+
+        timestamps.append(now)
+        return None
+
+    def _purge(self, state, now):
+        # Ticket của worker đã chết hoặc bị giữ quá lâu (lỗi không release) không được chiếm ngân sách mãi
+        tickets = state['tickets']
+        for key in [k for k, t in tickets.items() if not pid_alive(t['pid']) or now - t['started'] > self.ticket_ttl]:
+            logger.warning(f'Admission ticket {key} expired')
+            tickets.pop(key)
+
+        rates = state['rates']
+        for client in [c for c, times in rates.items() if not times or now - times[-1] >= self.rate_window]:
+            rates.pop(client)
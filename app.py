@@ -1,23 +1,91 @@
-from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for
+from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for, Response, stream_with_context
 from werkzeug.utils import secure_filename
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
 import uuid
 import json
 import zipfile
+import zlib
 import shutil
 import logging
 import sys
 from datetime import datetime
-from PIL import Image, ImageOps
+from PIL import Image, ImageOps, UnidentifiedImageError, features
 import io
+import threading
+import time
 import xml.etree.ElementTree as ET
+import hashlib
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
 from PIL.PngImagePlugin import PngInfo
+from storage import ArtifactStore, ResultCache, path_size
+from jobs import JobQueue, QueueFull
+from metrics import Metrics, BYTES_BUCKETS
+from memory import MemoryBudget, MemoryBudgetBusy, current_tracker, tracking
+from targets import IconTargets, Task
+from ico import bmp_frame, build_ico
+from admission import AdmissionController, Rejected
+from warmup import Readiness, preload_codecs
 
 # Production configuration
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 15 * 1024 * 1024  # 15MB max file size
-app.config['UPLOAD_FOLDER'] = 'temp'
+# Thư mục tạm: artifact chờ download, cache kết quả và trạng thái dùng chung giữa các worker
+app.config['UPLOAD_FOLDER'] = os.environ.get('TEMP_DIR', 'temp')
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'fallback-secret-key-for-development')
+# Chất lượng resample cho pyramid: exact | balanced | fast
+app.config['RESAMPLE_QUALITY'] = os.environ.get('RESAMPLE_QUALITY', 'balanced')
+# Cache kết quả theo nội dung upload (0 = tắt)
+app.config['RESULT_CACHE_MAX_BYTES'] = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+app.config['RESULT_CACHE_TTL'] = int(os.environ.get('RESULT_CACHE_TTL', 24 * 60 * 60))
+# Số thread resize/encode song song cho mỗi worker (1 = tuần tự)
+app.config['ENCODE_WORKERS'] = int(os.environ.get('ENCODE_WORKERS', min(os.cpu_count() or 1, 8)))
+# Profile encoder mặc định: fast | balanced | smallest (có thể chọn theo từng request)
+app.config['ENCODER_PROFILE'] = os.environ.get('ENCODER_PROFILE', 'balanced')
+# Hàng đợi job: số job chạy đồng thời và số job chờ tối đa trong mỗi worker
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))
+app.config['JOB_QUEUE_SIZE'] = int(os.environ.get('JOB_QUEUE_SIZE', 8))
+app.config['JOB_RETRY_AFTER'] = int(os.environ.get('JOB_RETRY_AFTER', 5))
+# Số pixel tối đa của ảnh upload (kiểm tra từ header trước khi decode)
+app.config['MAX_IMAGE_PIXELS'] = int(os.environ.get('MAX_IMAGE_PIXELS', 50_000_000))
+Image.MAX_IMAGE_PIXELS = app.config['MAX_IMAGE_PIXELS']
+# Số ảnh tối đa trong một request batch
+app.config['BATCH_MAX_ITEMS'] = int(os.environ.get('BATCH_MAX_ITEMS', 50))
+# Tổng dung lượng (sau giải nén) tối đa của các ảnh trong một batch
+app.config['BATCH_MAX_TOTAL_BYTES'] = int(os.environ.get('BATCH_MAX_TOTAL_BYTES', 64 * 1024 * 1024))
+# Admission control: ngân sách chi phí chung cho mọi worker (0 = tắt, mặc định), giới hạn theo client (0 = không giới hạn)
+app.config['ADMISSION_BUDGET'] = float(os.environ.get('ADMISSION_BUDGET', 0))
+app.config['ADMISSION_CLIENT_CONCURRENCY'] = int(os.environ.get('ADMISSION_CLIENT_CONCURRENCY', 2))
+app.config['ADMISSION_RATE_LIMIT'] = int(os.environ.get('ADMISSION_RATE_LIMIT', 60))
+app.config['ADMISSION_RATE_WINDOW'] = int(os.environ.get('ADMISSION_RATE_WINDOW', 60))
+app.config['ADMISSION_QUEUE_TIMEOUT'] = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 10))
+# Worker sync chỉ có một thread: chỉ chờ ngân sách một chút để không giữ worker lâu
+app.config['ADMISSION_SYNC_QUEUE_TIMEOUT'] = float(os.environ.get('ADMISSION_SYNC_QUEUE_TIMEOUT', 2))
+app.config['ADMISSION_CHEAP_COST'] = float(os.environ.get('ADMISSION_CHEAP_COST', 6))
+app.config['ADMISSION_CHEAP_RESERVE'] = float(os.environ.get('ADMISSION_CHEAP_RESERVE', 0.25))
+# Thuật toán quantize palette: mediancut | fastoctree | libimagequant, dither: none | floyd-steinberg
+app.config['QUANTIZER'] = os.environ.get('QUANTIZER', 'mediancut')
+app.config['QUANTIZE_DITHER'] = os.environ.get('QUANTIZE_DITHER', 'none')
+# File JSON khai báo thêm/ghi đè profile icon (định dạng xem targets.py)
+app.config['ICON_PROFILES_FILE'] = os.environ.get('ICON_PROFILES_FILE')
+# Vòng đời file trong temp/: thời gian giữ, quota dung lượng và chu kỳ dọn dẹp (giây)
+app.config['ARTIFACT_TTL'] = int(os.environ.get('ARTIFACT_TTL', 60 * 60))
+app.config['TEMP_QUOTA_BYTES'] = int(os.environ.get('TEMP_QUOTA_BYTES', 1024 * 1024 * 1024))
+app.config['ARTIFACT_REAP_INTERVAL'] = int(os.environ.get('ARTIFACT_REAP_INTERVAL', 60))
+# Bộ nhớ: standard | bounded (không copy cả frame, thu nhỏ trước khi xử lý alpha), giới hạn mỗi request (0 = tắt)
+app.config['MEMORY_MODE'] = os.environ.get('MEMORY_MODE', 'standard')
+app.config['MEMORY_LIMIT_BYTES'] = int(os.environ.get('MEMORY_LIMIT_BYTES', 0))
+# Đo thêm peak allocation Python bằng tracemalloc (làm chậm pipeline, chỉ bật khi cần phân tích)
+app.config['MEMORY_TRACE'] = os.environ.get('MEMORY_TRACE', '0') == '1'
+# Số proxy tin cậy đứng trước app (Fly.io / Render: 1), remote_addr lấy từ X-Forwarded-For của chúng.
+# 0 = không tin header (chạy trực tiếp, client tự gửi X-Forwarded-For để né giới hạn theo client)
+app.config['PROXY_FIX_HOPS'] = int(os.environ.get('PROXY_FIX_HOPS', 0))
+# Warm-up pipeline trước khi nhận traffic: auto (khi chạy server) | on | off
+app.config['WARMUP'] = os.environ.get('WARMUP', 'auto')
+
+if app.config['PROXY_FIX_HOPS']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_HOPS'])
 
 # Production logging
 if not app.debug:
@@ -30,72 +98,199 @@ if not app.debug:
     app.logger.info('🚀 Favicon Generator Production Mode Started')
 
 # Tạo thư mục temp nếu chưa tồn tại
-if not os.path.exists('temp'):
-    os.makedirs('temp')
+TEMP_DIR = app.config['UPLOAD_FOLDER']
+os.makedirs(TEMP_DIR, exist_ok=True)
+
+# Cache dùng chung giữa các worker, nằm trong temp/.cache
+result_cache = ResultCache(
+    os.path.join(TEMP_DIR, '.cache'),
+    app.config['RESULT_CACHE_MAX_BYTES'],
+    app.config['RESULT_CACHE_TTL']
+)
+
+# Profile icon theo nền tảng và planner (built-in + ICON_PROFILES_FILE)
+icon_targets = IconTargets.load(app.config['ICON_PROFILES_FILE'])
+
+# Artifact chờ download (ZIP, thư mục favicon-only), index nằm trong temp/.store
+artifact_store = ArtifactStore(
+    TEMP_DIR,
+    app.config['ARTIFACT_TTL'],
+    app.config['TEMP_QUOTA_BYTES'],
+    reap_interval=app.config['ARTIFACT_REAP_INTERVAL'],
+    sweep_dirs=[os.path.join(TEMP_DIR, '.jobs')]
+)
+
+# Ngân sách chi phí và giới hạn theo client dùng chung giữa các worker, nằm trong temp/.admission
+admission = AdmissionController(
+    os.path.join(TEMP_DIR, '.admission'),
+    app.config['ADMISSION_BUDGET'],
+    client_concurrency=app.config['ADMISSION_CLIENT_CONCURRENCY'],
+    rate_limit=app.config['ADMISSION_RATE_LIMIT'],
+    rate_window=app.config['ADMISSION_RATE_WINDOW'],
+    cheap_cost=app.config['ADMISSION_CHEAP_COST'],
+    cheap_reserve=app.config['ADMISSION_CHEAP_RESERVE'],
+    queue_timeout=app.config['ADMISSION_QUEUE_TIMEOUT']
+)
+
+# Ngân sách bộ nhớ của process (MEMORY_LIMIT_BYTES), mỗi lần generate giữ trước phần ước lượng từ header
+memory_budget = MemoryBudget(app.config['MEMORY_LIMIT_BYTES'])
+
+# Trạng thái warm-up / sẵn sàng của process (/readyz)
+readiness = Readiness()
+
+# Metrics theo từng worker, cộng dồn khi scrape /metrics
+metrics = Metrics(os.path.join(TEMP_DIR, '.metrics'))
+metrics.describe('favicon_requests_total', 'counter', 'Số request tạo icon theo generation_type')
+metrics.describe('favicon_failures_total', 'counter', 'Số request tạo icon bị lỗi theo generation_type')
+metrics.describe('favicon_input_format_total', 'counter', 'Số ảnh upload theo định dạng')
+metrics.describe('favicon_request_duration_seconds', 'histogram', 'Thời gian xử lý toàn bộ một request')
+metrics.describe('favicon_stage_duration_seconds', 'histogram', 'Thời gian từng stage của pipeline')
+metrics.describe('favicon_jobs_in_flight', 'gauge', 'Số job đang chạy')
+metrics.describe('favicon_temp_bytes', 'gauge', 'Dung lượng đang chiếm trong temp/')
+metrics.describe('favicon_artifacts', 'gauge', 'Số artifact đang chờ download')
+metrics.describe('favicon_artifact_bytes', 'gauge', 'Dung lượng artifact đang chờ download')
+metrics.describe('favicon_artifact_quota_bytes', 'gauge', 'Quota dung lượng artifact (TEMP_QUOTA_BYTES)')
+metrics.describe('favicon_artifacts_expired_total', 'counter', 'Số artifact bị xóa do hết TTL')
+metrics.describe('favicon_artifacts_evicted_total', 'counter', 'Số artifact bị xóa do vượt quota')
+metrics.describe('favicon_admission_wait_seconds', 'histogram', 'Thời gian chờ ngân sách trước khi được nhận')
+metrics.describe('favicon_admission_total', 'counter', 'Số request qua admission control theo kết quả (admitted / queued)')
+metrics.describe('favicon_admission_rejected_total', 'counter', 'Số request bị từ chối theo lý do (rate / concurrency / budget)')
+metrics.describe('favicon_admission_inflight_cost', 'gauge', 'Tổng chi phí ước lượng của các request đang chạy')
+metrics.describe('favicon_admission_budget', 'gauge', 'Ngân sách chi phí (ADMISSION_BUDGET)')
+metrics.describe('favicon_result_cache_hits_total', 'counter', 'Số lần trúng cache kết quả')
+metrics.describe('favicon_result_cache_misses_total', 'counter', 'Số lần trượt cache kết quả')
+metrics.describe('favicon_stage_peak_bytes', 'histogram', 'Peak bộ nhớ của request trong từng stage', buckets=BYTES_BUCKETS)
+metrics.describe('favicon_stage_rss_delta_bytes', 'histogram', 'RSS tăng thêm sau từng stage', buckets=BYTES_BUCKETS)
+metrics.describe('favicon_request_peak_bytes', 'histogram', 'Peak bộ nhớ của toàn bộ một request', buckets=BYTES_BUCKETS)
+metrics.describe('favicon_ready', 'gauge', 'Worker đã warm-up xong và sẵn sàng nhận traffic (1 / 0)')
+metrics.describe('favicon_startup_seconds', 'gauge', 'Thời gian từ lúc process khởi động đến khi sẵn sàng')
+metrics.describe('favicon_warmup_seconds', 'gauge', 'Thời gian chạy warm-up')
+metrics.describe('favicon_memory_rejected_total', 'counter', 'Số request bị từ chối do MEMORY_LIMIT_BYTES theo bước (preflight / busy)')
+
+@contextmanager
+def track_stage(stage, generation_type):
+    """
+    Đo thời gian một stage của pipeline vào histogram favicon_stage_duration_seconds,
+    kèm bộ nhớ của stage nếu request đang được đo (xem memory_tracking)
+    """
+    tracker = current_tracker()
+    start = time.perf_counter()
+    try:
+        with tracker.stage(stage) if tracker else nullcontext():
+            yield
+    finally:
+        metrics.observe('favicon_stage_duration_seconds',
+                        {'stage': stage, 'generation_type': generation_type},
+                        time.perf_counter() - start)
+
+def generation_type_of(only_favicon):
+    return 'favicon_only' if only_favicon else 'full_set'
+
+@contextmanager
+def memory_tracking(generation_type):
+    """Đo bộ nhớ từng stage của một request, ghi log và metrics khi xong"""
+    with tracking(app.config['MEMORY_TRACE']) as tracker:
+        try:
+            yield tracker
+        finally:
+            report = tracker.to_dict()
+            for stage, record in report['stages'].items():
+                labels = {'stage': stage, 'generation_type': generation_type}
+                metrics.observe('favicon_stage_peak_bytes', labels, max(record['rss_peak'], record.get('traced_peak', 0)))
+                metrics.observe('favicon_stage_rss_delta_bytes', labels, max(record['rss_delta'], 0))
+            if report['stages']:
+                metrics.observe('favicon_request_peak_bytes', {'generation_type': generation_type}, report['peak'])
+                app.logger.info('Memory ' + ' '.join(
+                    f"{stage}={max(r['rss_peak'], r.get('traced_peak', 0)) / 1048576:.1f}MB"
+                    for stage, r in report['stages'].items()) + f" peak={report['peak'] / 1048576:.1f}MB")
 
 # Các định dạng file được phép
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+# Plugin Pillow được phép decode (không thử các định dạng khác)
+ALLOWED_FORMATS = ('PNG', 'JPEG', 'GIF')
+# Chỉ nạp sẵn plugin cần dùng (cùng ICO để ghi favicon.ico), Pillow không phải import mọi plugin ở request đầu
+preload_codecs()
+
+class ImageRejected(ValueError):
+    """Ảnh upload bị từ chối ở bước preflight (chưa decode pixel nào)"""
+    
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
 
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def get_icon_sizes(only_favicon=False):
-    """Lấy danh sách kích thước icon cần tạo - luôn sử dụng đuôi PNG"""
-    if only_favicon:
-        return {'favicon.ico': 16}
-    
-    sizes = {
-        # Web favicons
-        "favicon-16x16.png": 16,
-        "favicon-32x32.png": 32,
-        "favicon-96x96.png": 96,
-        
-        # Android icons
-        "android-icon-36x36.png": 36,
-        "android-icon-48x48.png": 48,
-        "android-icon-72x72.png": 72,
-        "android-icon-96x96.png": 96,
-        "android-icon-144x144.png": 144,
-        "android-icon-192x192.png": 192,
-        
-        # Apple Touch icons
-        "apple-icon-40x40.png": 40,
-        "apple-icon-58x58.png": 58,
-        "apple-icon-60x60.png": 60,
-        "apple-icon-76x76.png": 76,
-        "apple-icon-80x80.png": 80,
-        "apple-icon-87x87.png": 87,
-        "apple-icon-114x114.png": 114,
-        "apple-icon-120x120.png": 120,
-        "apple-icon-128x128.png": 128,
-        "apple-icon-136x136.png": 136,
-        "apple-icon-144x144.png": 144,
-        "apple-icon-152x152.png": 152,
-        "apple-icon-167x167.png": 167,
-        "apple-icon-180x180.png": 180,
-        "apple-icon-192x192.png": 192,
-        "apple-icon-1024x1024.png": 1024,
-        
-        # Microsoft icons
-        "ms-icon-70x70.png": 70,
-        "ms-icon-144x144.png": 144,
-        "ms-icon-150x150.png": 150,
-        "ms-icon-310x310.png": 310
-    }
-    
-    # Thêm favicon.ico
-    sizes['favicon.ico'] = 16
-    
-    return sizes
+def get_plan(only_favicon=False, maintain_dimensions=True):
+    """Kế hoạch encode (file -> task không trùng lặp) cho generation_type của request"""
+    return icon_targets.plan_for(generation_type_of(only_favicon), maintain_dimensions)
+
+# Trọng số ước lượng chi phí, đơn vị ~ một favicon_only từ ảnh nhỏ
+COST_PER_MEGAPIXEL = 1.0
+COST_PER_TASK = 0.5
+
+def estimate_cost(image_size, only_favicon=False):
+    """
+    Chi phí ước lượng của một request từ kích thước header (decode) và số lần encode của plan,
+    task ICO tính theo số frame
+    """
+    width, height = image_size
+    encodes = sum(len(task.frames) or 1 for task in get_plan(only_favicon).tasks)
+    return 1 + width * height / 1_000_000 * COST_PER_MEGAPIXEL + encodes * COST_PER_TASK
+
+# Hệ số tối thiểu giữa level nguồn và kích thước đích khi resize từ pyramid.
+# None = luôn resize LANCZOS trực tiếp từ ảnh gốc (chậm nhất, chính xác nhất),
+# giá trị càng nhỏ thì càng dùng level nhỏ (reduce bằng box filter) => càng nhanh.
+RESAMPLE_QUALITIES = {
+    'exact': None,
+    'balanced': 2.0,
+    'fast': 1.0,
+}
+
+# Profile encoder PNG:
+# - compress_level / compress_type: mức nén và chiến lược zlib (-1 = Pillow tự chọn theo loại ảnh)
+# - optimize: cho zlib thử nén mạnh nhất (chậm)
+# - quantize_min_size: từ kích thước này trở lên chuyển sang palette 256 màu (None = không quantize)
+# - zip_compression: kiểu nén cho entry PNG trong ZIP (PNG đã nén sẵn nên STORED gần như không lớn hơn)
+ENCODER_PROFILES = {
+    'fast': {
+        'compress_level': 1,
+        'compress_type': zlib.Z_RLE,
+        'optimize': False,
+        'quantize_min_size': None,
+        'zip_compression': zipfile.ZIP_STORED,
+    },
+    'balanced': {
+        'compress_level': 9,
+        'compress_type': -1,
+        'optimize': True,
+        'quantize_min_size': 1024,
+        'zip_compression': zipfile.ZIP_STORED,
+    },
+    'smallest': {
+        'compress_level': 9,
+        'compress_type': zlib.Z_FILTERED,
+        'optimize': True,
+        'quantize_min_size': 256,
+        'zip_compression': zipfile.ZIP_DEFLATED,
+    },
+}
+
+def get_encoder_profile(name=None):
+    """Lấy profile encoder theo tên (mặc định theo config)"""
+    name = name or app.config['ENCODER_PROFILE']
+    if name not in ENCODER_PROFILES:
+        raise ValueError(f'Encoder profile không hợp lệ: {name}')
+    return ENCODER_PROFILES[name]
 
 def has_transparency(img):
     """Kiểm tra xem ảnh có nền trong suốt không"""
     if img.mode == 'RGBA':
-        # Lấy alpha channel
-        alpha = img.split()[-1]
-        # Kiểm tra xem có pixel nào có alpha < 255 không
-        return alpha.getbbox() is not None and min(alpha.getextrema()) < 255
+        # Extrema của alpha lấy trực tiếp từ ảnh, không tách các band thành ảnh riêng.
+        # Có pixel alpha < 255 và không phải toàn bộ trong suốt
+        low, high = img.getextrema()[3]
+        return high > 0 and low < 255
     elif img.mode == 'P' and 'transparency' in img.info:
         return True
     return False
@@ -107,8 +302,8 @@ def add_white_background(img):
     
     # Tạo background trắng
     background = Image.new('RGB', img.size, (255, 255, 255))
-    # Paste ảnh lên background, sử dụng alpha channel làm mask
-    background.paste(img, mask=img.split()[-1])
+    # Paste ảnh lên background, ảnh RGBA làm mask thì Pillow dùng luôn band alpha (không split)
+    background.paste(img, mask=img)
     
     return background
 
@@ -124,192 +319,1068 @@ def compress_image(img, target_size=None):
     # Chỉ cần lưu với quality thấp hơn
     return img
 
-def save_optimized_png(img, path, max_quality=80):
+# Thuật toán quantize palette (libimagequant chỉ có khi Pillow được build kèm)
+QUANTIZE_METHODS = {
+    'mediancut': Image.Quantize.MEDIANCUT,
+    'fastoctree': Image.Quantize.FASTOCTREE,
+    'libimagequant': Image.Quantize.LIBIMAGEQUANT,
+}
+QUANTIZE_DITHERS = {
+    'none': Image.Dither.NONE,
+    'floyd-steinberg': Image.Dither.FLOYDSTEINBERG,
+}
+
+def available_quantizers():
+    """Các thuật toán quantize dùng được với bản Pillow đang cài"""
+    return [name for name in QUANTIZE_METHODS if name != 'libimagequant' or features.check('libimagequant')]
+
+# Pillow không có libimagequant thì quay về mediancut thay vì làm hỏng mọi request
+if app.config['QUANTIZER'] not in available_quantizers():
+    app.logger.warning(f"Quantizer {app.config['QUANTIZER']} không khả dụng, dùng mediancut")
+    app.config['QUANTIZER'] = 'mediancut'
+
+class PaletteQuantizer:
+    """
+    Palette 256 màu tính một lần từ ảnh nguồn (master của request) và dùng lại cho mọi output cần quantize.
+    Output trùng pixel với ảnh nguồn (size 1024) nhận luôn kết quả quantize, các size khác chỉ map màu vào palette.
+    """
+    
+    def __init__(self, source, method=None, dither=None, colors=256):
+        method = method or app.config['QUANTIZER']
+        dither = dither or app.config['QUANTIZE_DITHER']
+        if method not in available_quantizers():
+            raise ValueError(f'Quantizer không hợp lệ hoặc không khả dụng: {method}')
+        if dither not in QUANTIZE_DITHERS:
+            raise ValueError(f'Dither không hợp lệ: {dither}')
+        
+        self.source = source if source.mode == 'RGB' else source.convert('RGB')
+        self.method = QUANTIZE_METHODS[method]
+        self.dither = QUANTIZE_DITHERS[dither]
+        self.colors = colors
+        self._palette = None
+        self._lock = threading.Lock()
+    
+    def palette_image(self):
+        """Ảnh nguồn đã quantize (chứa palette), tính lười một lần kể cả khi nhiều thread encode cùng gọi"""
+        with self._lock:
+            if self._palette is None:
+                self._palette = self.source.quantize(self.colors, method=self.method)
+            return self._palette
+    
+    def quantize(self, img):
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        palette = self.palette_image()
+        # Pillow chỉ dither khi map vào palette có sẵn, không dither lúc tính palette
+        if (self.dither == Image.Dither.NONE and img.size == self.source.size
+                and img.tobytes() == self.source.tobytes()):
+            return palette
+        return img.quantize(palette=palette, dither=self.dither)
+
+def save_optimized_png(img, fp, max_quality=80, compress_level=9, compress_type=-1, quantizer=None):
     """
     Lưu PNG với compression mạnh sử dụng palette mode để giảm kích thước đáng kể
+    fp có thể là đường dẫn hoặc file object (BytesIO)
+    quantizer: PaletteQuantizer dùng chung của request (None = tính palette riêng cho ảnh này)
     """
     # Log kích thước trước khi compress
     original_size = img.size
-    app.logger.info(f'Compressing image {original_size} to: {path}')
+    app.logger.info(f'Compressing image {original_size}')
     
     # Đảm bảo mode RGB
     if img.mode != 'RGB':
         img = img.convert('RGB')
     
     # Convert sang P mode (palette) với 256 màu - giống pngquant
-    # Sử dụng dithering để giữ chất lượng
-    img_palette = img.convert('P', palette=Image.Palette.ADAPTIVE, colors=256)
+    if quantizer is None:
+        quantizer = PaletteQuantizer(img)
+    img_palette = quantizer.quantize(img)
     
     # Lưu với compression tối đa
     img_palette.save(
-        path,
+        fp,
         format='PNG',
         optimize=True,
-        compress_level=9
+        compress_level=compress_level,
+        compress_type=compress_type
     )
     
     # Log kích thước file sau khi compress
-    if os.path.exists(path):
-        file_size = os.path.getsize(path) / 1024  # KB
-        app.logger.info(f'Compressed PNG saved: {path} ({file_size:.1f} KB)')
+    file_size = (fp.tell() if hasattr(fp, 'tell') else os.path.getsize(fp)) / 1024  # KB
+    app.logger.info(f'Compressed PNG saved ({file_size:.1f} KB)')
     
-    return path
+    return fp
 
-def create_icons_from_image(image_path, sizes, temp_path, maintain_dimensions=True):
-    """Tạo icons từ hình ảnh gốc - luôn xuất ra PNG"""
-    original_image = Image.open(image_path)
+_encode_executor = None
+_encode_executor_key = None
+_encode_executor_lock = threading.Lock()
+_encode_thread_state = threading.local()
+
+def _mark_encode_thread():
+    _encode_thread_state.in_pool = True
+
+def get_encode_executor():
+    """
+    Thread pool dùng chung để resize/encode song song trong một worker.
+    Pillow nhả GIL khi resample và nén zlib nên thread chạy thật sự song song,
+    master được chia sẻ trực tiếp mà không cần pickle.
+    Pool được tạo lại sau fork (gunicorn --preload) vì thread không đi theo process con,
+    và khi ENCODE_WORKERS thay đổi lúc chạy.
+    """
+    global _encode_executor, _encode_executor_key
     
-    # Kiểm tra và xử lý nền trong suốt
-    if has_transparency(original_image):
-        app.logger.info('Detected transparent background, adding white background')
-        original_image = add_white_background(original_image)
+    workers = app.config['ENCODE_WORKERS']
+    if workers <= 1:
+        return None
+    
+    with _encode_executor_lock:
+        key = (os.getpid(), workers)
+        if _encode_executor is None or _encode_executor_key != key:
+            if _encode_executor is not None and _encode_executor_key[0] == os.getpid():
+                _encode_executor.shutdown(wait=False)
+            _encode_executor = ThreadPoolExecutor(
+                max_workers=workers,
+                thread_name_prefix='encode',
+                initializer=_mark_encode_thread
+            )
+            _encode_executor_key = key
+        return _encode_executor
+
+def iter_tasks(func, items):
+    """Chạy func cho từng item (song song nếu bật ENCODE_WORKERS), trả về iterator theo đúng thứ tự"""
+    executor = get_encode_executor()
+    # Task đang chạy trong pool (ví dụ một item của batch) thì chạy tuần tự để tránh deadlock
+    if executor is None or getattr(_encode_thread_state, 'in_pool', False):
+        return map(func, items)
+    return executor.map(func, items)
+
+def run_tasks(func, items):
+    """Như iter_tasks nhưng chờ tất cả hoàn thành và trả về list"""
+    return list(iter_tasks(func, items))
+
+def encode_image(img, size, profile=None, quantizer=None):
+    """Encode ảnh đã resize thành PNG theo profile encoder (ICO dùng encode_ico với pyramid)"""
+    profile = get_encoder_profile(profile)
+    buffer = io.BytesIO()
+    
+    if profile['quantize_min_size'] is not None and size >= profile['quantize_min_size']:
+        # Quantize palette cho các size lớn, các size khác giữ nguyên
+        save_optimized_png(img, buffer, max_quality=80,
+                           compress_level=profile['compress_level'],
+                           compress_type=profile['compress_type'],
+                           quantizer=quantizer)
     else:
-        # Chuyển đổi sang RGB nếu không có alpha
-        if original_image.mode != 'RGB':
-            original_image = original_image.convert('RGB')
+        save_png(img, buffer, profile)
     
-    for filename, size in sizes.items():
-        try:
-            # Tạo bản sao của hình ảnh gốc
-            img = original_image.copy()
-            
-            if maintain_dimensions:
-                # Resize giữ tỷ lệ và thêm padding trắng
-                img.thumbnail((size, size), Image.Resampling.LANCZOS)
-                
-                # Tạo canvas trắng
-                new_img = Image.new('RGB', (size, size), (255, 255, 255))
-                
-                # Tính toán vị trí để căn giữa
-                x = (size - img.width) // 2
-                y = (size - img.height) // 2
-                
-                # Dán hình ảnh vào giữa canvas
-                new_img.paste(img, (x, y))
-                img = new_img
-            else:
-                # Resize cưỡng bức về kích thước chính xác
-                img = img.resize((size, size), Image.Resampling.LANCZOS)
-            
-            # Lưu file
-            file_path = os.path.join(temp_path, filename)
-            
-            if filename.endswith('.ico'):
-                # Tạo file ICO - chuyển về RGBA cho ICO
-                img_ico = img.convert('RGBA')
-                img_ico.save(file_path, format='ICO', sizes=[(size, size)])
-            else:
-                # Compress cho size 1024x1024, các size khác giữ nguyên
-                if size == 1024:
-                    save_optimized_png(img, file_path, max_quality=80)
-                else:
-                    img.save(file_path, format='PNG', optimize=True)
-                    
-        except Exception as e:
-            app.logger.error(f"Lỗi khi tạo {filename}: {str(e)}")
+    return buffer.getvalue()
+
+def save_png(img, fp, profile):
+    """PNG truecolor theo mức nén của profile encoder (không quantize)"""
+    img.save(fp, format='PNG',
+             optimize=profile['optimize'],
+             compress_level=profile['compress_level'],
+             compress_type=profile['compress_type'])
+
+# Frame ICO từ kích thước này trở lên nhúng PNG, nhỏ hơn ghi BMP 32-bit
+ICO_PNG_MIN_SIZE = 64
+
+def reusable_frames(encoded, fit, profile=None):
+    """PNG truecolor (không quantize) đã encode trong request theo size, dùng lại làm frame ICO"""
+    min_size = get_encoder_profile(profile)['quantize_min_size']
+    return {task.size: data for task, data in encoded.items()
+            if task.encoding == 'png' and task.fit == fit and data is not None
+            and (min_size is None or task.size < min_size)}
+
+def encode_ico(pyramid, frames, profile=None, pngs=None):
+    """
+    ICO nhiều độ phân giải từ các frame đã resize trong pyramid.
+    Frame lớn nhúng PNG: lấy luôn bytes trong pngs (PNG cùng size đã encode cho output khác) nếu có,
+    nên ICO gần như không tốn thêm CPU khi chạy cùng full set.
+    """
+    pngs = pngs or {}
+    entries = []
+    for size in frames:
+        if size < ICO_PNG_MIN_SIZE:
+            entries.append((size, bmp_frame(pyramid[size])))
+        elif size in pngs:
+            entries.append((size, pngs[size]))
+        else:
+            buffer = io.BytesIO()
+            save_png(pyramid[size], buffer, get_encoder_profile(profile))
+            entries.append((size, buffer.getvalue()))
+    return build_ico(entries)
+
+def zip_compression_for(arcname, profile=None):
+    """Kiểu nén ZIP cho một entry - PNG theo profile, các file khác luôn DEFLATED"""
+    if arcname.endswith('.png'):
+        return get_encoder_profile(profile)['zip_compression']
+    return zipfile.ZIP_DEFLATED
+
+# Thời gian cố định cho mọi entry ZIP: cùng nội dung luôn cho cùng bytes (tên download theo hash nội dung)
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+def zip_entry(arcname, profile=None):
+    """ZipInfo không phụ thuộc thời điểm tạo file"""
+    info = zipfile.ZipInfo(arcname, date_time=ZIP_DATE_TIME)
+    info.compress_type = zip_compression_for(arcname, profile)
+    info.external_attr = 0o644 << 16
+    return info
+
+def write_icons(rendered, directory):
+    """Ghi các icon đã encode ra thư mục (tạo thư mục con như icons/), bỏ qua icon bị lỗi"""
+    for filename, data in rendered:
+        if data is None:
             continue
+        path = os.path.join(directory, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
 
-def create_apple_icons_folder(image_path, temp_path, maintain_dimensions=True):
-    """Tạo thư mục icons với tên đơn giản cho Apple - luôn xuất ra PNG"""
-    icons_path = os.path.join(temp_path, 'icons')
-    os.makedirs(icons_path, exist_ok=True)
+def fit_image(img, size, maintain_dimensions=True, in_place=False):
+    """
+    Resize ảnh về khung size x size - giữ tỷ lệ với padding trắng hoặc resize cưỡng bức.
+    in_place: caller không dùng lại img nên thumbnail thẳng trên img, không copy cả frame.
+    """
+    if maintain_dimensions:
+        # Resize giữ tỷ lệ và thêm padding trắng
+        if not in_place:
+            img = img.copy()
+        img.thumbnail((size, size), Image.Resampling.LANCZOS, reducing_gap=None)
+        
+        # Tạo canvas trắng
+        new_img = Image.new('RGB', (size, size), (255, 255, 255))
+        
+        # Tính toán vị trí để căn giữa
+        x = (size - img.width) // 2
+        y = (size - img.height) // 2
+        
+        # Dán hình ảnh vào giữa canvas
+        new_img.paste(img, (x, y))
+        return new_img
     
-    apple_sizes = [48, 72, 96, 120, 144, 152, 167, 180, 192, 1024]
-    original_image = Image.open(image_path)
+    # Resize cưỡng bức về kích thước chính xác
+    return img.resize((size, size), Image.Resampling.LANCZOS)
+
+# Kích thước ảnh master sau khi chuẩn hóa
+MASTER_SIZE = 1024
+
+def normalize_image(img, maintain_dimensions=True, in_place=False):
+    """
+    Chuẩn hóa ảnh upload thành master RGB MASTER_SIZE x MASTER_SIZE trong bộ nhớ.
+    Ảnh chỉ được decode một lần, master này được truyền cho mọi generator
+    (không ghi file trung gian, không quantize).
+    in_place: caller không dùng lại img (ví dụ ảnh vừa decode) nên được sửa trực tiếp.
+    """
+    app.logger.info(f'Original image: {img.size}, mode: {img.mode}, format: {img.format}')
+    source = img
     
     # Kiểm tra và xử lý nền trong suốt
-    if has_transparency(original_image):
-        original_image = add_white_background(original_image)
+    if has_transparency(img):
+        app.logger.info('Adding white background to transparent image')
+        img = add_white_background(img)
+    else:
+        # Chuyển sang RGB nếu chưa phải
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+    
+    # Tối ưu hóa kích thước về 1024x1024
+    if img.size != (MASTER_SIZE, MASTER_SIZE):
+        app.logger.info(f'Resizing from {img.size} to {MASTER_SIZE}x{MASTER_SIZE}')
+        img = fit_image(img, MASTER_SIZE, maintain_dimensions, in_place=in_place or img is not source)
+    
+    return img
+
+# MEMORY_MODE=bounded: số dòng ảnh gốc được chuyển mode và reduce mỗi lần (làm tròn theo hệ số reduce)
+REDUCE_STRIP_ROWS = 64
+
+def reduce_strip_rows(factor):
+    """Chiều cao dải ngang khi reduce theo hệ số factor, luôn là bội số của factor"""
+    return factor * max(REDUCE_STRIP_ROWS // factor, 1)
+
+def reduce_for_master(img, maintain_dimensions=True):
+    """
+    MEMORY_MODE=bounded: giảm ảnh lớn theo hệ số nguyên (box filter) về gần kích thước master cần
+    trước khi xử lý alpha / chuyển mode, các bước sau chỉ chạy trên ảnh nhỏ.
+    Ảnh được reduce theo từng dải ngang: chỉ một dải được chuyển mode (reduce không hỗ trợ P)
+    hoặc nhân alpha, không tạo bản sao nào cùng kích thước ảnh gốc.
+    """
+    target = master_decode_size(img.size, maintain_dimensions)
+    factor = min(img.width // target[0], img.height // target[1])
+    if factor < 2:
+        return img
+    if img.mode in ('RGB', 'L'):
+        return img.reduce(factor)
+    mode = img.mode if img.mode in ('RGBA', 'LA') else ('RGBA' if has_transparency(img) else 'RGB')
+    
+    reduced = Image.new(mode, (-(-img.width // factor), -(-img.height // factor)))
+    rows = reduce_strip_rows(factor)
+    for top in range(0, img.height, rows):
+        # Dải cao bội số của factor nên các ô reduce trùng với khi reduce cả ảnh
+        strip = img.crop((0, top, img.width, min(top + rows, img.height)))
+        if strip.mode != mode:
+            strip = strip.convert(mode)
+        reduced.paste(strip.reduce(factor), (0, top // factor))
+    return reduced
+
+# Pillow lưu mọi frame nhiều kênh (RGB, RGBA, LA, CMYK) 4 bytes mỗi pixel, kể cả RGB
+FRAME_BYTES = 4
+# Giai đoạn resize / encode: master, canvas, các level pyramid và bộ đệm encode, tính theo số frame master
+PIPELINE_FRAMES = 6
+
+def pixel_bytes(mode):
+    """Số bytes Pillow cấp cho mỗi pixel của mode: 1 cho 1/L/P, 2 cho I;16, còn lại 4"""
+    if mode in ('1', 'L', 'P'):
+        return 1
+    return 2 if mode.startswith('I;16') else FRAME_BYTES
+
+def normalize_memory(size, mode, transparent=False):
+    """Bộ nhớ normalize_image cần thêm (ngoài chính ảnh đầu vào) để chuẩn hóa ảnh size / mode thành master"""
+    width, height = size
+    pixels = width * height
+    # Ảnh không phải RGB được chuyển thành frame RGB hoặc dán lên frame nền trắng cùng kích thước,
+    # ảnh palette trong suốt qua thêm một bản RGBA trước khi dán
+    converted = 0 if mode == 'RGB' else pixels * FRAME_BYTES
+    conversion = converted * 2 if mode == 'P' and transparent else converted
+    # LANCZOS chạy chiều ngang trước: frame trung gian rộng tối đa MASTER_SIZE, cao bằng ảnh, cộng frame đích
+    resize = (MASTER_SIZE * height + MASTER_SIZE * MASTER_SIZE) * FRAME_BYTES
+    return max(conversion, converted + resize)
+
+def estimate_memory(image_format, size, mode, transparent=False):
+    """
+    Ước lượng peak bộ nhớ (bytes) của một lần generate theo MEMORY_MODE, chỉ từ header.
+    Dùng để từ chối sớm ảnh vượt MEMORY_LIMIT_BYTES trước khi decode.
+    transparent: header có khai báo màu trong suốt (ảnh palette).
+    """
+    width, height = size
+    target = master_decode_size(size)
+    if image_format == 'JPEG':
+        # draft decode ở tỷ lệ 1/2, 1/4 hoặc 1/8
+        scale = min(width // target[0], height // target[1])
+        scale = next((s for s in (8, 4, 2) if scale >= s), 1)
+        width, height = -(-width // scale), -(-height // scale)
+    
+    pixels = width * height
+    decoded = pixels * pixel_bytes(mode)
+    factor = max(min(width // target[0], height // target[1]), 1)
+    if app.config['MEMORY_MODE'] == 'bounded' and factor > 1:
+        # Mỗi dải được cắt, chuyển mode và nhân alpha (premultiplied) trước khi reduce
+        reduced_mode = mode if mode in ('RGB', 'RGBA', 'L', 'LA') else ('RGBA' if transparent else 'RGB')
+        strip = 0 if mode in ('RGB', 'L') else reduce_strip_rows(factor) * width * FRAME_BYTES * 3
+        reduced_size = -(-width // factor), -(-height // factor)
+        reduced = reduced_size[0] * reduced_size[1] * pixel_bytes(reduced_mode)
+        # Ảnh decode được giải phóng ngay sau reduce, chỉ ảnh đã thu nhỏ được chuẩn hóa
+        peak = max(decoded + strip + reduced,
+                   reduced + normalize_memory(reduced_size, reduced_mode, transparent))
     else:
-        if original_image.mode != 'RGB':
-            original_image = original_image.convert('RGB')
+        peak = decoded + normalize_memory((width, height), mode, transparent)
+    
+    # Ảnh decode đã được giải phóng khi resize / encode bắt đầu
+    return max(peak, MASTER_SIZE * MASTER_SIZE * FRAME_BYTES * PIPELINE_FRAMES)
+
+def preflight_image(data):
+    """
+    Chỉ đọc header để kiểm tra định dạng và kích thước trước khi decode pixel.
+    Trả về (format, (width, height)), raise ImageRejected nếu không hợp lệ hoặc quá lớn.
+    """
+    try:
+        with Image.open(io.BytesIO(data), formats=ALLOWED_FORMATS) as img:
+            image_format, (width, height), mode = img.format, img.size, img.mode
+            transparent = 'transparency' in img.info
+    except Image.DecompressionBombError:
+        raise ImageRejected('Ảnh quá lớn', status=413)
+    except (UnidentifiedImageError, OSError):
+        raise ImageRejected('File không phải ảnh PNG, JPEG hoặc GIF hợp lệ')
+    
+    if width * height > app.config['MAX_IMAGE_PIXELS']:
+        raise ImageRejected(
+            f"Ảnh quá lớn ({width}x{height}), tối đa {app.config['MAX_IMAGE_PIXELS'] // 1_000_000} megapixel",
+            status=413
+        )
+    
+    limit = app.config['MEMORY_LIMIT_BYTES']
+    if limit:
+        estimate = estimate_memory(image_format, (width, height), mode, transparent)
+        if estimate > limit:
+            metrics.inc('favicon_memory_rejected_total', {'step': 'preflight'})
+            raise ImageRejected(
+                f'Ảnh cần khoảng {estimate // (1024 * 1024)}MB bộ nhớ, tối đa {limit // (1024 * 1024)}MB',
+                status=413
+            )
+    
+    return image_format, (width, height)
+
+def acquire_memory(data, timeout=0):
+    """
+    Giữ trước bộ nhớ ước lượng từ header trong ngân sách của process (MEMORY_LIMIT_BYTES).
+    Trả về số bytes đã giữ (trả lại bằng memory_budget.release), raise MemoryBudgetBusy (503)
+    nếu các request khác vẫn giữ ngân sách sau timeout giây.
+    """
+    if not memory_budget.limit:
+        return 0
+    image_format, size = preflight_image(data)
+    with Image.open(io.BytesIO(data), formats=ALLOWED_FORMATS) as img:
+        estimate = estimate_memory(image_format, size, img.mode, 'transparency' in img.info)
+    try:
+        return memory_budget.acquire(estimate, timeout)
+    except MemoryBudgetBusy as e:
+        metrics.inc('favicon_memory_rejected_total', {'step': 'busy'})
+        app.logger.warning(str(e))
+        raise
+
+def master_decode_size(size, maintain_dimensions=True):
+    """Kích thước nhỏ nhất cần decode để vẫn đủ tạo master MASTER_SIZE"""
+    width, height = size
+    if not maintain_dimensions:
+        return MASTER_SIZE, MASTER_SIZE
+    scale = MASTER_SIZE / max(width, height)
+    return max(int(width * scale), 1), max(int(height * scale), 1)
+
+def decode_source(data, maintain_dimensions=True):
+    """
+    Preflight header rồi decode ảnh upload, trả về ảnh đã load.
+    JPEG lớn được decode thẳng ở tỷ lệ 1/2, 1/4 hoặc 1/8 (draft) gần với kích thước master cần,
+    ảnh nhỏ hơn 2 lần master được decode như cũ.
+    """
+    preflight_image(data)
+    
+    img = Image.open(io.BytesIO(data), formats=ALLOWED_FORMATS)
+    if img.format == 'JPEG':
+        target = master_decode_size(img.size, maintain_dimensions)
+        if min(img.width // target[0], img.height // target[1]) >= 2:
+            original_size = img.size
+            img.draft(None, target)
+            app.logger.info(f'Reduced JPEG decode {original_size} -> {img.size}')
+    img.load()
+    return img
+
+def reduce_source(img, maintain_dimensions=True):
+    """MEMORY_MODE=bounded: thu nhỏ ảnh vừa decode (reduce_for_master) và giải phóng ảnh gốc, mode khác trả về img"""
+    if app.config['MEMORY_MODE'] == 'bounded':
+        reduced = reduce_for_master(img, maintain_dimensions)
+        if reduced is not img:
+            # Giải phóng bộ đệm pixel của ảnh decode ngay, chỉ giữ ảnh đã thu nhỏ
+            img.close()
+            img = reduced
+    return img
+
+def normalize_source(img, maintain_dimensions=True):
+    """Chuẩn hóa ảnh vừa decode thành master, ảnh decode được sửa tại chỗ hoặc giải phóng"""
+    img = reduce_source(img, maintain_dimensions)
+    return normalize_image(img, maintain_dimensions, in_place=True)
+
+def decode_master(data, maintain_dimensions=True, generation_type='full_set'):
+    """Decode một lần rồi chuẩn hóa thành master, đo theo stage decode và normalize"""
+    with track_stage('decode', generation_type):
+        img = decode_source(data, maintain_dimensions)
+    metrics.inc('favicon_input_format_total', {'format': img.format or 'unknown'})
+    
+    with track_stage('normalize', generation_type):
+        return normalize_source(img, maintain_dimensions)
+
+def build_resize_pyramid(master, sizes, maintain_dimensions=True, quality=None):
+    """
+    Tạo pyramid resample: mỗi kích thước chỉ resize một lần cho cả request.
+    Các level trung gian được giảm dần bằng reduce(2) (box filter), sau đó mỗi
+    kích thước đích chạy một lần LANCZOS từ level nhỏ nhất vẫn đủ lớn.
+    Trả về dict {size: Image} để mọi output đọc chung.
+    """
+    quality = quality or app.config['RESAMPLE_QUALITY']
+    if quality not in RESAMPLE_QUALITIES:
+        raise ValueError(f'Resample quality không hợp lệ: {quality}')
+    gap = RESAMPLE_QUALITIES[quality]
+    
+    levels = [master]
+    sources = {}
     
-    for size in apple_sizes:
+    # Duyệt từ lớn đến nhỏ để level chỉ cần giảm dần
+    for size in sorted(set(sizes), reverse=True):
+        if gap is not None:
+            while min(levels[-1].size) // 2 >= size * gap:
+                levels.append(levels[-1].reduce(2))
+        sources[size] = levels[-1]
+    
+    # Bước LANCZOS cuối cho từng kích thước độc lập nên có thể chạy song song
+    sizes = list(sources)
+    resized = run_tasks(lambda size: fit_image(sources[size], size, maintain_dimensions), sizes)
+    return dict(zip(sizes, resized))
+
+def render_plan(master, plan, maintain_dimensions=True, pyramid=None, progress=None, profile=None):
+    """
+    Encode mỗi task của plan đúng một lần rồi trả về iterator (filename, bytes) theo thứ tự output,
+    các file dùng chung task nhận cùng bytes; manifest.json / browserconfig.xml ở cuối.
+    Task ICO được ghép từ frame của pyramid và PNG cùng size đã encode, không chạy trên pool.
+    progress (nếu có) được gọi sau mỗi task.
+    """
+    if pyramid is None:
+        pyramid = build_resize_pyramid(master, plan.sizes, maintain_dimensions)
+    # Palette tính từ master một lần (chỉ khi có size cần quantize), dùng chung cho mọi task
+    quantizer = PaletteQuantizer(master)
+    
+    # MEMORY_MODE=bounded: bỏ frame của pyramid ngay khi task cuối cùng dùng nó encode xong
+    remaining = None
+    if app.config['MEMORY_MODE'] == 'bounded':
+        remaining = {}
+        for task in plan.tasks:
+            for size in task.frames or (task.size,):
+                remaining[size] = remaining.get(size, 0) + 1
+    remaining_lock = threading.Lock()
+    
+    def finish(task):
+        if remaining is not None:
+            with remaining_lock:
+                for size in task.frames or (task.size,):
+                    remaining[size] -= 1
+                    if remaining[size] == 0:
+                        pyramid.pop(size, None)
+        if progress:
+            progress()
+    
+    def render(task):
         try:
-            img = original_image.copy()
-            
-            if maintain_dimensions:
-                img.thumbnail((size, size), Image.Resampling.LANCZOS)
-                new_img = Image.new('RGB', (size, size), (255, 255, 255))
-                x = (size - img.width) // 2
-                y = (size - img.height) // 2
-                new_img.paste(img, (x, y))
-                img = new_img
-            else:
-                img = img.resize((size, size), Image.Resampling.LANCZOS)
-            
-            # Luôn sử dụng đuôi .png
-            filename = f"{size}x{size}.png"
-            file_path = os.path.join(icons_path, filename)
-            
-            # Chỉ compress cho size 1024x1024, các size khác giữ nguyên
-            if size == 1024:
-                save_optimized_png(img, file_path, max_quality=80)
-            else:
-                img.save(file_path, format='PNG', optimize=True)
-                
+            return encode_image(pyramid[task.size], task.size, profile, quantizer)
         except Exception as e:
-            app.logger.error(f"Lỗi khi tạo Apple icon {size}x{size}: {str(e)}")
-            continue
-
-def create_manifest(temp_path):
-    """Tạo file manifest.json - luôn sử dụng PNG"""
-    manifest = {
-        "name": "Generated App",
-        "icons": [
-            {"src": "/android-icon-36x36.png", "sizes": "36x36", "type": "image/png", "density": "0.75"},
-            {"src": "/android-icon-48x48.png", "sizes": "48x48", "type": "image/png", "density": "1.0"},
-            {"src": "/android-icon-72x72.png", "sizes": "72x72", "type": "image/png", "density": "1.5"},
-            {"src": "/android-icon-96x96.png", "sizes": "96x96", "type": "image/png", "density": "2.0"},
-            {"src": "/android-icon-144x144.png", "sizes": "144x144", "type": "image/png", "density": "3.0"},
-            {"src": "/android-icon-192x192.png", "sizes": "192x192", "type": "image/png", "density": "4.0"}
-        ]
-    }
+            app.logger.error(f"Lỗi khi tạo icon {task.size}x{task.size} ({task.encoding}): {str(e)}")
+            return None
+        finally:
+            finish(task)
     
-    with open(os.path.join(temp_path, 'manifest.json'), 'w', encoding='utf-8') as f:
-        json.dump(manifest, f, indent=2, ensure_ascii=False)
-
-def create_browserconfig(temp_path):
-    """Tạo file browserconfig.xml - luôn sử dụng PNG"""
-    browserconfig = '''<?xml version="1.0" encoding="utf-8"?>
-<browserconfig>
-    <msapplication>
-        <tile>
-            <square70x70logo src="/ms-icon-70x70.png"/>
-            <square150x150logo src="/ms-icon-150x150.png"/>
-            <square310x310logo src="/ms-icon-310x310.png"/>
-            <TileColor>#ffffff</TileColor>
-        </tile>
-    </msapplication>
-</browserconfig>'''
-    
-    with open(os.path.join(temp_path, 'browserconfig.xml'), 'w', encoding='utf-8') as f:
-        f.write(browserconfig)
-
-def create_zip_file(temp_path, unique_id):
-    """Tạo file ZIP chứa tất cả icons"""
-    zip_path = os.path.join('temp', f'favicon-{unique_id}.zip')
+    def render_ico(task):
+        try:
+            return encode_ico(pyramid, task.frames, profile, reusable_frames(encoded, task.fit, profile))
+        except Exception as e:
+            app.logger.error(f"Lỗi khi tạo ICO {task.frames}: {str(e)}")
+            return None
+        finally:
+            finish(task)
+    
+    encoded = {}
+    tasks = [task for task in plan.tasks if not task.frames]
+    results = zip(tasks, iter_tasks(render, tasks))
+    
+    def wait_for(needed):
+        while not needed.issubset(encoded):
+            done_task, data = next(results)
+            encoded[done_task] = data
     
+    for filename, task in plan.files:
+        if task.frames and task not in encoded:
+            # Chờ PNG cùng size của các frame lớn (nếu plan có) để dùng lại bytes thay vì encode lại
+            wait_for({Task(size, task.fit, 'png') for size in task.frames if size >= ICO_PNG_MIN_SIZE}
+                     .intersection(tasks))
+            encoded[task] = render_ico(task)
+        # Task được encode theo thứ tự xuất hiện đầu tiên nên file đầu tiên không phải chờ cả plan
+        wait_for({task})
+        yield filename, encoded[task]
+    
+    yield from plan.documents
+
+def zip_directory(directory, zip_path, profile=None):
+    """Nén toàn bộ file trong directory vào zip_path (kiểu nén từng entry theo profile encoder)"""
     with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, dirs, files in os.walk(temp_path):
-            for file in files:
+        for root, dirs, files in os.walk(directory):
+            # Thứ tự entry cố định để ZIP tạo lại từ cùng nội dung giống hệt từng byte
+            dirs.sort()
+            for file in sorted(files):
                 if file.startswith('original.'):
                     continue  # Bỏ qua file gốc
                 
                 file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, temp_path)
-                zipf.write(file_path, arcname)
+                arcname = os.path.relpath(file_path, directory)
+                with open(file_path, 'rb') as f:
+                    zipf.writestr(zip_entry(arcname, profile), f.read())
+    
+    return zip_path
+
+def create_zip_file(temp_path, unique_id, profile=None):
+    """Tạo file ZIP chứa tất cả icons"""
+    zip_path = zip_directory(temp_path, os.path.join(TEMP_DIR, f'favicon-{unique_id}.zip'), profile)
     
     # Xóa thư mục temp sau khi tạo ZIP xong
     cleanup_directory(temp_path)
     
     return zip_path
 
+class ZipStream(io.RawIOBase):
+    """File object chỉ ghi (không seek) - zipfile sẽ dùng data descriptor, bytes được gom lại để yield"""
+    
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+    
+    def writable(self):
+        return True
+    
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+    
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def render_icon_set(master, maintain_dimensions=True, progress=None, profile=None):
+    """Toàn bộ entry của full set theo thứ tự của plan (icons, icons/ của Apple, manifest.json, browserconfig.xml)"""
+    return render_plan(master, get_plan(False, maintain_dimensions), maintain_dimensions,
+                       progress=progress, profile=profile)
+
+def stream_zip(entries, profile=None):
+    """Ghi từng entry vào ZIP ngay khi được encode và yield bytes ra response (không ghi đĩa)"""
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for arcname, data in entries:
+            if data is None:
+                continue
+            zipf.writestr(zip_entry(arcname, profile), data)
+            yield stream.drain()
+    yield stream.drain()
+
 def cleanup_directory(directory):
     """Xóa thư mục và nội dung"""
     if os.path.exists(directory):
         shutil.rmtree(directory)
 
+def artifact_result(name, only_favicon, lease):
+    """Kết quả trả về cho client cho artifact đã publish (ZIP hoặc thư mục chứa favicon.ico)"""
+    # Lease của riêng request này: /cleanup chỉ trả đúng lease đó, không ảnh hưởng client khác
+    cleanup_url = f'/cleanup/{name}?lease={lease}'
+    if only_favicon:
+        return {
+            'success': True,
+            'download_url': f'/direct/{name}/favicon',
+            'cleanup_url': cleanup_url,
+            'is_single_file': True,
+            'filename': 'favicon.ico'
+        }
+    
+    return {
+        'success': True,
+        'download_url': f'/download/{name}',
+        'cleanup_url': cleanup_url,
+        'is_single_file': False
+    }
+
+def publish_artifact(source_path, only_favicon):
+    """
+    Đưa artifact vào temp/ dưới tên theo hash nội dung (URL download bất biến, cache được ở CDN)
+    rồi đăng ký với artifact store. Output giống nhau từ nhiều request dùng chung một file.
+    """
+    with open(source_path, 'rb') as f:
+        digest = hashlib.file_digest(f, 'sha256').hexdigest()[:32]
+    
+    if only_favicon:
+        name = digest
+        lease = artifact_store.publish(source_path, name, 'favicon.ico')
+    else:
+        name = f'favicon-{digest}.zip'
+        lease = artifact_store.publish(source_path, name)
+    
+    return artifact_result(name, only_favicon, lease)
+
+def artifact_etag(name):
+    """ETag mạnh của artifact = hash nội dung nằm trong tên"""
+    return name[len('favicon-'):-len('.zip')] if name.endswith('.zip') else name
+
+def count_outputs(only_favicon):
+    """Số task encode (không tính file trùng) - dùng để báo tiến độ"""
+    return len(get_plan(only_favicon).tasks)
+
+def create_icon_set(data, temp_path, maintain_dimensions=True, only_favicon=False, progress=None, profile=None):
+    """Decode upload một lần và ghi toàn bộ icon set (icons, icons/ Apple, manifest, browserconfig) vào temp_path"""
+    generation_type = generation_type_of(only_favicon)
+    
+    # Giữ trước bộ nhớ cho đến khi ghi xong, chạy trên thread job nên được chờ request khác trả ngân sách
+    reserved = acquire_memory(data, app.config['ADMISSION_QUEUE_TIMEOUT'])
+    try:
+        # Decode một lần và chuẩn hóa thành master trong bộ nhớ
+        master = decode_master(data, maintain_dimensions, generation_type)
+        
+        os.makedirs(temp_path, exist_ok=True)
+        
+        # Mỗi (size, fit, encoding) chỉ encode một lần dù xuất hiện ở nhiều nền tảng
+        plan = get_plan(only_favicon, maintain_dimensions)
+        
+        # Resize một lần cho tất cả kích thước của plan
+        with track_stage('resize', generation_type):
+            pyramid = build_resize_pyramid(master, plan.sizes, maintain_dimensions)
+        
+        with track_stage('encode', generation_type):
+            rendered = render_plan(master, plan, maintain_dimensions, pyramid, progress, profile)
+            # render_plan giữ tham chiếu riêng, master / pyramid được giải phóng ngay khi encode xong
+            del master, pyramid
+            write_icons(rendered, temp_path)
+    finally:
+        memory_budget.release(reserved)
+
+def generation_options(maintain_dimensions, only_favicon, profile=None):
+    """Các tùy chọn ảnh hưởng tới output - dùng làm một phần của cache key"""
+    return {
+        'maintain_dimensions': maintain_dimensions,
+        'only_favicon': only_favicon,
+        'resample_quality': app.config['RESAMPLE_QUALITY'],
+        'encoder_profile': profile or app.config['ENCODER_PROFILE'],
+        'quantizer': f"{app.config['QUANTIZER']}/{app.config['QUANTIZE_DITHER']}",
+        'targets': get_plan(only_favicon, maintain_dimensions).fingerprint
+    }
+
+def save_to_cache(cache_key, path):
+    """Lưu kết quả vào cache, lỗi cache chỉ ghi log - request vẫn trả về kết quả vừa tạo"""
+    try:
+        result_cache.put(cache_key, path)
+    except Exception as e:
+        app.logger.warning(f'Result cache put failed {cache_key[:12]}: {e}')
+
+def run_generation(data, maintain_dimensions=True, only_favicon=False, progress=None, profile=None, cache_key=None):
+    """
+    Chạy toàn bộ pipeline cho một upload và trả về dict kết quả cho client.
+    progress (nếu có) được gọi sau mỗi icon hoàn thành.
+    cache_key: key đã tra trượt ở view (cached_result), không tra lại cache lần nữa
+    """
+    # Tra cache theo nội dung upload + tùy chọn trước khi decode
+    if cache_key is None:
+        cache_key = ResultCache.key_for(data, generation_options(maintain_dimensions, only_favicon, profile))
+        cached_path = result_cache.get(cache_key)
+        if cached_path:
+            app.logger.info(f'Result cache hit {cache_key[:12]}')
+            return publish_artifact(cached_path, only_favicon)
+    
+    # Tạo thư mục tạm thời
+    unique_id = str(uuid.uuid4())[:16]
+    temp_path = os.path.join(TEMP_DIR, unique_id)
+    create_icon_set(data, temp_path, maintain_dimensions, only_favicon, progress, profile)
+    
+    # Nếu chỉ tạo favicon
+    if only_favicon:
+        favicon_path = os.path.join(temp_path, 'favicon.ico')
+        if os.path.exists(favicon_path):
+            try:
+                save_to_cache(cache_key, favicon_path)
+                return publish_artifact(favicon_path, only_favicon)
+            finally:
+                cleanup_directory(temp_path)
+    
+    # Tạo file ZIP
+    with track_stage('zip', generation_type_of(only_favicon)):
+        zip_path = create_zip_file(temp_path, unique_id, profile)
+    
+    try:
+        save_to_cache(cache_key, zip_path)
+        return publish_artifact(zip_path, only_favicon)
+    finally:
+        os.remove(zip_path)
+
+def run_batch(items, progress=None):
+    """
+    Tạo icon set cho nhiều ảnh, mỗi ảnh một thư mục trong cùng một ZIP.
+    Các item chạy song song trên pool encode; item lỗi được ghi vào báo cáo mà không dừng cả batch.
+    """
+    batch_id = str(uuid.uuid4())[:16]
+    batch_path = os.path.join(TEMP_DIR, batch_id)
+    os.makedirs(batch_path, exist_ok=True)
+    
+    # Item chạy trên thread encode nên gắn lại tracker bộ nhớ của request
+    tracker = current_tracker()
+    
+    def process(item):
+        item_path = os.path.join(batch_path, item['name'])
+        try:
+            with tracker.activate() if tracker else nullcontext():
+                create_icon_set(item['data'], item_path, item['maintain_dimensions'],
+                                item['only_favicon'], progress, item['profile'])
+            return {'name': item['name'], 'success': True}
+        except Exception as e:
+            app.logger.error(f"Lỗi khi tạo batch item {item['name']}: {str(e)}")
+            cleanup_directory(item_path)
+            return {'name': item['name'], 'success': False, 'message': str(e)}
+        finally:
+            item['data'] = None
+    
+    # Có MEMORY_LIMIT_BYTES thì chạy lần lượt trên thread job: item chờ ngân sách bộ nhớ
+    # không được chiếm thread encode mà request đang giữ ngân sách cần dùng
+    report = [process(item) for item in items] if memory_budget.limit else run_tasks(process, items)
+    with open(os.path.join(batch_path, 'batch-report.json'), 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    
+    with track_stage('zip', 'batch'):
+        zip_path = create_zip_file(batch_path, batch_id)
+    try:
+        result = publish_artifact(zip_path, only_favicon=False)
+    finally:
+        os.remove(zip_path)
+    result['items'] = report
+    return result
+
+def run_job(payload, job):
+    """Runner cho hàng đợi job - một ảnh hoặc một batch"""
+    generation_type = 'batch' if 'items' in payload else generation_type_of(payload['only_favicon'])
+    labels = {'generation_type': generation_type}
+    metrics.inc('favicon_requests_total', labels)
+    metrics.gauge_add('favicon_jobs_in_flight')
+    start = time.perf_counter()
+    
+    try:
+        with memory_tracking(generation_type):
+            if 'items' in payload:
+                job.set_total(sum(count_outputs(item['only_favicon']) for item in payload['items']))
+                return run_batch(payload['items'], progress=job.advance)
+            
+            job.set_total(count_outputs(payload['only_favicon']))
+            return run_generation(payload['data'], payload['maintain_dimensions'], payload['only_favicon'],
+                                  progress=job.advance, profile=payload['profile'],
+                                  cache_key=payload.get('cache_key'))
+    except Exception:
+        metrics.inc('favicon_failures_total', labels)
+        raise
+    finally:
+        # Trả lại ngân sách của admission control (job có thể chạy xong sau khi request đã trả về)
+        admission.release(payload.get('ticket'))
+        metrics.observe('favicon_request_duration_seconds', labels, time.perf_counter() - start)
+        metrics.gauge_add('favicon_jobs_in_flight', delta=-1)
+        metrics.flush()
+
+# Hàng đợi job trong từng worker, trạng thái lưu ở temp/.jobs để mọi worker đọc được
+job_queue = JobQueue(
+    os.path.join(TEMP_DIR, '.jobs'),
+    run_job,
+    workers=app.config['JOB_WORKERS'],
+    maxsize=app.config['JOB_QUEUE_SIZE']
+)
+
+def read_upload():
+    """Kiểm tra file upload và các tùy chọn, trả về (payload, None) hoặc (None, response lỗi)"""
+    # Kiểm tra file upload
+    if 'image' not in request.files:
+        app.logger.warning('No file uploaded')
+        return None, (jsonify({'success': False, 'message': 'Không có file được tải lên'}), 400)
+    
+    file = request.files['image']
+    if file.filename == '':
+        return None, (jsonify({'success': False, 'message': 'Không có file được chọn'}), 400)
+    
+    if not allowed_file(file.filename):
+        return None, (jsonify({'success': False, 'message': 'Định dạng file không được hỗ trợ'}), 400)
+    
+    # Lấy các tùy chọn
+    try:
+        payload = read_options(request.form, {})
+    except ValueError as e:
+        return None, (jsonify({'success': False, 'message': str(e)}), 400)
+    
+    payload['data'] = file.read()
+    
+    # Kiểm tra header trước khi đưa vào hàng đợi, kích thước dùng để ước lượng chi phí
+    try:
+        image_format, payload['image_size'] = preflight_image(payload['data'])
+    except ImageRejected as e:
+        app.logger.warning(f'Rejected upload: {str(e)}')
+        return None, (jsonify({'success': False, 'message': str(e)}), e.status)
+    
+    return payload, None
+
+def read_options(options, defaults):
+    """Tùy chọn tạo icon từ dict (form hoặc JSON của từng item), thiếu thì lấy theo defaults"""
+    maintain_dimensions = options.get('maintain_dimensions', defaults.get('maintain_dimensions'))
+    generation_type = options.get('generation_type', defaults.get('generation_type')) or 'full_set'
+    profile = options.get('encoder_profile', defaults.get('encoder_profile')) or app.config['ENCODER_PROFILE']
+    if profile not in ENCODER_PROFILES:
+        raise ValueError(f'Encoder profile không hợp lệ: {profile}')
+    
+    return {
+        'maintain_dimensions': maintain_dimensions in (True, 'on'),
+        'only_favicon': generation_type == 'favicon_only',
+        'profile': profile
+    }
+
+def read_batch_upload():
+    """
+    Đọc các ảnh của batch: nhiều file ở field images và/hoặc một file ZIP ở field archive.
+    Tùy chọn riêng cho từng ảnh nằm trong field options (JSON: {tên file: {...}}).
+    """
+    sources = []
+    for file in request.files.getlist('images'):
+        if file.filename and allowed_file(file.filename):
+            sources.append((file.filename, file.read()))
+    total = sum(len(data) for _, data in sources)
+    
+    archive = request.files.get('archive')
+    if archive and archive.filename:
+        with zipfile.ZipFile(io.BytesIO(archive.read())) as zipf:
+            for info in zipf.infolist():
+                name = os.path.basename(info.filename)
+                if info.is_dir() or info.filename.startswith('__MACOSX') or not allowed_file(name):
+                    continue
+                # Chặn zip bomb: mỗi ảnh không được lớn hơn giới hạn upload, tổng không vượt giới hạn của batch
+                if info.file_size > app.config['MAX_CONTENT_LENGTH']:
+                    raise ValueError(f'File {name} trong archive quá lớn')
+                total += info.file_size
+                if total > app.config['BATCH_MAX_TOTAL_BYTES']:
+                    raise ValueError(f"Tổng dung lượng ảnh trong batch tối đa "
+                                     f"{app.config['BATCH_MAX_TOTAL_BYTES'] // (1024 * 1024)}MB")
+                if len(sources) >= app.config['BATCH_MAX_ITEMS']:
+                    raise ValueError(f"Tối đa {app.config['BATCH_MAX_ITEMS']} ảnh mỗi batch")
+                sources.append((name, zipf.read(info)))
+    
+    if not sources:
+        raise ValueError('Không có file ảnh hợp lệ được tải lên')
+    if len(sources) > app.config['BATCH_MAX_ITEMS']:
+        raise ValueError(f"Tối đa {app.config['BATCH_MAX_ITEMS']} ảnh mỗi batch")
+    
+    per_item = json.loads(request.form.get('options') or '{}')
+    if not isinstance(per_item, dict) or not all(isinstance(options, dict) for options in per_item.values()):
+        raise ValueError('options phải là JSON object {tên file: {tùy chọn}}')
+    items = []
+    used_names = set()
+    for filename, data in sources:
+        # Tên thư mục trong ZIP theo tên file, thêm hậu tố nếu trùng
+        base = secure_filename(filename.rsplit('.', 1)[0]) or 'image'
+        name = base
+        index = 2
+        while name in used_names:
+            name = f'{base}-{index}'
+            index += 1
+        used_names.add(name)
+        
+        item = read_options(per_item.get(filename, {}), request.form)
+        item.update({'name': name, 'data': data})
+        items.append(item)
+    
+    return items
+
+def batch_cost(items):
+    """Tổng chi phí ước lượng của batch (ảnh không đọc được header tính như ảnh master)"""
+    total = 0
+    for item in items:
+        try:
+            image_format, image_size = preflight_image(item['data'])
+        except ImageRejected:
+            image_size = (MASTER_SIZE, MASTER_SIZE)
+        total += estimate_cost(image_size, item['only_favicon'])
+    return total
+
+def busy_response(message, status, retry_after):
+    """429 / 503 kèm Retry-After"""
+    response = jsonify({'success': False, 'message': message})
+    response.status_code = status
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def queue_full_response():
+    """429 kèm Retry-After khi hàng đợi job đã đầy"""
+    return busy_response('Máy chủ đang bận, vui lòng thử lại sau', 429, app.config['JOB_RETRY_AFTER'])
+
+def job_failed_response(job):
+    """Job lỗi: giữ status của lỗi (413 ảnh vượt giới hạn bộ nhớ, 503 hết ngân sách bộ nhớ), còn lại 500"""
+    if job.error_status == 503:
+        return busy_response(job.message, 503, app.config['JOB_RETRY_AFTER'])
+    return jsonify({'success': False, 'message': f'Lỗi xử lý: {job.message}'}), job.error_status or 500
+
+def admission_timeout():
+    """
+    Thời gian được chờ ngân sách: worker sync của gunicorn (wsgi.multithread = False) chỉ có một thread,
+    chờ lâu sẽ giữ cả worker không làm gì nên chỉ chờ ADMISSION_SYNC_QUEUE_TIMEOUT,
+    worker nhiều thread thì chờ ADMISSION_QUEUE_TIMEOUT
+    """
+    if request.environ.get('wsgi.multithread'):
+        return app.config['ADMISSION_QUEUE_TIMEOUT']
+    return min(app.config['ADMISSION_SYNC_QUEUE_TIMEOUT'], app.config['ADMISSION_QUEUE_TIMEOUT'])
+
+def admit_request(cost):
+    """Admission control trước khi chạy pipeline, trả về (ticket, None) hoặc (None, response 429/503)"""
+    client = request.remote_addr or 'unknown'
+    start = time.perf_counter()
+    try:
+        ticket = admission.admit(client, cost, admission_timeout())
+    except Rejected as e:
+        app.logger.warning(f'Rejected request from {client} ({e.reason}, cost {cost:.1f})')
+        return None, busy_response(str(e), e.status, e.retry_after)
+    metrics.observe('favicon_admission_wait_seconds', {}, time.perf_counter() - start)
+    return ticket, None
+
+def cached_result(payload):
+    """
+    Kết quả đã có trong cache thì publish luôn (không tính chi phí, không qua hàng đợi), chưa có thì None.
+    Khi trượt, key được giữ trong payload để job không tra lại cache (mỗi request chỉ tính một hit / miss).
+    """
+    options = generation_options(payload['maintain_dimensions'], payload['only_favicon'], payload['profile'])
+    cache_key = ResultCache.key_for(payload['data'], options)
+    cached_path = result_cache.get(cache_key)
+    if not cached_path:
+        payload['cache_key'] = cache_key
+        return None
+    app.logger.info(f'Result cache hit {cache_key[:12]}')
+    return publish_artifact(cached_path, payload['only_favicon'])
+
+def admit_and_submit(payload, cost):
+    """Admission control rồi đưa vào hàng đợi job, trả về (job, None) hoặc (None, response lỗi)"""
+    ticket, error = admit_request(cost)
+    if error:
+        return None, error
+    
+    payload['ticket'] = ticket
+    try:
+        return job_queue.submit(payload), None
+    except QueueFull:
+        admission.release(ticket)
+        return None, queue_full_response()
+
+def warm_up():
+    """
+    Chạy toàn bộ pipeline một lần trên ảnh tổng hợp trong bộ nhớ: decode PNG / JPEG / GIF, chuẩn hóa
+    (cả nhánh nền trong suốt), pyramid, quantize, encode PNG / ICO và ZIP.
+    Không ghi đĩa, không đụng cache và metrics.
+    """
+    gradient = Image.linear_gradient('L').resize((512, 512))
+    sample = Image.merge('RGBA', (gradient, gradient.rotate(90), gradient.rotate(180),
+                                  gradient.transpose(Image.Transpose.FLIP_TOP_BOTTOM)))
+    
+    for image_format in ALLOWED_FORMATS:
+        buffer = io.BytesIO()
+        (sample if image_format == 'PNG' else sample.convert('RGB')).save(buffer, format=image_format)
+        with Image.open(io.BytesIO(buffer.getvalue()), formats=ALLOWED_FORMATS) as img:
+            img.load()
+    
+    master = normalize_image(sample, in_place=True)
+    # Chạy tuần tự, không tạo thread pool encode: với gunicorn --preload warm-up chạy trong master
+    # trước khi fork, thread của pool không đi theo worker và không nên tồn tại lúc fork
+    workers = app.config['ENCODE_WORKERS']
+    app.config['ENCODE_WORKERS'] = 1
+    try:
+        for only_favicon in (False, True):
+            for chunk in stream_zip(render_plan(master, get_plan(only_favicon))):
+                pass
+    finally:
+        app.config['ENCODE_WORKERS'] = workers
+
+def warm_start():
+    """Warm-up (trừ khi WARMUP=off) rồi đánh dấu process sẵn sàng"""
+    if app.config['WARMUP'] == 'off':
+        readiness.mark_ready()
+    else:
+        readiness.run(warm_up)
+        app.logger.info(f'Warm-up xong trong {readiness.warmup_seconds:.2f}s')
+    app.logger.info(f'Sẵn sàng sau {readiness.startup_seconds:.2f}s kể từ lúc process khởi động')
+
+@app.before_request
+def start_background_tasks():
+    # Thread không đi theo process con sau fork (gunicorn --preload) nên khởi động lười
+    artifact_store.start_reaper()
+    # Server không warm-up lúc import (ví dụ flask run) thì warm-up ở request đầu tiên, trừ liveness probe
+    if not readiness.ready and request.endpoint != 'healthz':
+        warm_start()
+
+@app.route('/healthz')
+def healthz():
+    # Liveness: process còn trả lời được, không render template, không đọc đĩa
+    return Response('ok\n', mimetype='text/plain')
+
+@app.route('/readyz')
+def readyz():
+    # Readiness: warm-up xong và temp/ ghi được
+    status = readiness.to_dict()
+    status['temp_writable'] = os.access(TEMP_DIR, os.W_OK)
+    ready = status['ready'] and status['temp_writable']
+    return jsonify(status), 200 if ready else 503
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -319,132 +1390,165 @@ def generate():
     try:
         app.logger.info(f'New favicon generation request from {request.remote_addr}')
         
-        # Kiểm tra file upload
-        if 'image' not in request.files:
-            app.logger.warning('No file uploaded')
-            return jsonify({'success': False, 'message': 'Không có file được tải lên'}), 400
-        
-        file = request.files['image']
-        if file.filename == '':
-            return jsonify({'success': False, 'message': 'Không có file được chọn'}), 400
+        payload, error = read_upload()
+        if error:
+            return error
         
-        if not allowed_file(file.filename):
-            return jsonify({'success': False, 'message': 'Định dạng file không được hỗ trợ'}), 400
+        result = cached_result(payload)
+        if result:
+            return jsonify(result)
         
-        # Lấy các tùy chọn
-        maintain_dimensions = request.form.get('maintain_dimensions') == 'on'
-        generation_type = request.form.get('generation_type', 'full_set')
-        only_favicon = generation_type == 'favicon_only'
+        # Chạy qua admission control + hàng đợi job và chờ kết quả (giữ nguyên contract đồng bộ)
+        job, error = admit_and_submit(payload, estimate_cost(payload['image_size'], payload['only_favicon']))
+        if error:
+            return error
+        job.wait()
         
-        # Tạo thư mục tạm thời
-        unique_id = str(uuid.uuid4())[:16]
-        temp_path = os.path.join('temp', unique_id)
-        os.makedirs(temp_path, exist_ok=True)
+        if job.status == 'failed':
+            return job_failed_response(job)
+        return jsonify(job.result)
         
-        # Lưu file gốc
-        filename = secure_filename(file.filename)
-        original_extension = filename.rsplit('.', 1)[1].lower()
-        original_path = os.path.join(temp_path, f'original.{original_extension}')
-        file.save(original_path)
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Lỗi xử lý: {str(e)}'}), 500
 
-        # Mở và tối ưu hóa ảnh
-        with Image.open(original_path) as img:
-            app.logger.info(f'Original image: {img.size}, mode: {img.mode}, format: {original_extension}')
+@app.route('/generate/stream', methods=['POST'])
+def generate_stream():
+    try:
+        app.logger.info(f'New streaming favicon request from {request.remote_addr}')
+        
+        payload, error = read_upload()
+        if error:
+            return error
+        maintain_dimensions = payload['maintain_dimensions']
+        only_favicon = payload['only_favicon']
+        profile = payload['profile']
+        download_name = 'favicon.ico' if only_favicon else 'favicon-icons.zip'
+        
+        # Kết quả đã có trong cache thì gửi thẳng file
+        cache_key = ResultCache.key_for(payload['data'], generation_options(maintain_dimensions, only_favicon, profile))
+        cached_path = result_cache.get(cache_key)
+        if cached_path:
+            return send_file(os.path.abspath(cached_path), as_attachment=True, download_name=download_name)
+        
+        ticket, error = admit_request(estimate_cost(payload['image_size'], only_favicon))
+        if error:
+            return error
+        
+        reserved = 0
+        try:
+            # Chạy trên thread của request nên không chờ ngân sách bộ nhớ, hết thì trả về 503 ngay
+            reserved = acquire_memory(payload['data'])
+            # Decode và chuẩn hóa trước khi bắt đầu response để lỗi vẫn trả về JSON
+            generation_type = generation_type_of(only_favicon)
+            metrics.inc('favicon_requests_total', {'generation_type': generation_type})
+            # Phần stream sau khi trả response chạy ngoài context này nên chỉ đo được decode
+            with memory_tracking(generation_type):
+                master = decode_master(payload['data'], maintain_dimensions, generation_type)
             
-            # Kiểm tra và xử lý nền trong suốt
-            if has_transparency(img):
-                app.logger.info('Adding white background to transparent image')
-                img = add_white_background(img)
+            if only_favicon:
+                plan = get_plan(only_favicon, maintain_dimensions)
+                filename, data = next(render_plan(master, plan, maintain_dimensions, profile=profile))
+                response = Response(data, mimetype='image/x-icon', headers={
+                    'Content-Disposition': f'attachment; filename={download_name}'
+                })
             else:
-                # Chuyển sang RGB nếu chưa phải
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-            
-            # Tối ưu hóa kích thước về 1024x1024
-            if img.width != 1024 or img.height != 1024:
-                app.logger.info(f'Resizing from {img.size} to 1024x1024')
-                
-                if maintain_dimensions:
-                    # Giữ tỷ lệ: resize vào 1024x1024 với padding trắng
-                    img.thumbnail((1024, 1024), Image.Resampling.LANCZOS)
-                    
-                    # Tạo canvas trắng 1024x1024
-                    new_img = Image.new('RGB', (1024, 1024), (255, 255, 255))
-                    
-                    # Tính toán vị trí để căn giữa
-                    x = (1024 - img.width) // 2
-                    y = (1024 - img.height) // 2
-                    
-                    # Dán hình ảnh vào giữa canvas
-                    new_img.paste(img, (x, y))
-                    img = new_img
-                    app.logger.info(f'Resized with aspect ratio maintained, centered on 1024x1024 canvas')
-                else:
-                    # Không giữ tỷ lệ: resize cưỡng bức thành 1024x1024
-                    img = img.resize((1024, 1024), Image.Resampling.LANCZOS)
-                    app.logger.info(f'Resized to exact 1024x1024 (aspect ratio not maintained)')
-            
-            # Lưu lại ảnh đã tối ưu hóa - luôn chuyển sang PNG với compression
-            png_path = os.path.join(temp_path, 'original.png')
-            save_optimized_png(img, png_path, max_quality=80)
-            app.logger.info(f'Optimized image saved as PNG: {png_path}')
-            
-            # Xóa file gốc nếu không phải PNG
-            if original_extension.lower() != 'png':
-                os.remove(original_path)
-                app.logger.info(f'Removed original {original_extension} file, converted to PNG')
-                original_path = png_path
+                # Chunked response: entry đầu tiên được gửi khi các size sau vẫn đang encode
+                response = Response(
+                    stream_with_context(stream_zip(render_icon_set(master, maintain_dimensions, profile=profile), profile)),
+                    mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename={download_name}'}
+                )
+        except Exception:
+            memory_budget.release(reserved)
+            admission.release(ticket)
+            raise
         
-        # Lấy danh sách kích thước cần tạo
-        sizes = get_icon_sizes(only_favicon)
+        # Ngân sách (chi phí và bộ nhớ) được giữ đến khi stream xong
+        response.call_on_close(lambda: (memory_budget.release(reserved), admission.release(ticket)))
+        return response
         
-        # Tạo icons
-        create_icons_from_image(original_path, sizes, temp_path, maintain_dimensions)
+    except MemoryBudgetBusy as e:
+        return busy_response(str(e), e.status, app.config['JOB_RETRY_AFTER'])
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Lỗi xử lý: {str(e)}'}), 500
+
+@app.route('/batch', methods=['POST'])
+def generate_batch():
+    try:
+        app.logger.info(f'New batch favicon request from {request.remote_addr}')
         
-        # Nếu chỉ tạo favicon
-        if only_favicon:
-            favicon_path = os.path.join(temp_path, 'favicon.ico')
-            if os.path.exists(favicon_path):
-                return jsonify({
-                    'success': True,
-                    'download_url': f'/direct/{unique_id}/favicon',
-                    'is_single_file': True,
-                    'filename': 'favicon.ico'
-                })
+        try:
+            items = read_batch_upload()
+        except (ValueError, zipfile.BadZipFile) as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+        
+        job, error = admit_and_submit({'items': items}, batch_cost(items))
+        if error:
+            return error
+        job.wait()
         
-        # Tạo thêm các file bổ sung cho full set
-        if not only_favicon:
-            create_apple_icons_folder(original_path, temp_path, maintain_dimensions)
-            create_manifest(temp_path)
-            create_browserconfig(temp_path)
+        if job.status == 'failed':
+            return job_failed_response(job)
+        return jsonify(job.result)
         
-        # Tạo file ZIP
-        zip_path = create_zip_file(temp_path, unique_id)
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Lỗi xử lý: {str(e)}'}), 500
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    try:
+        app.logger.info(f'New async favicon job from {request.remote_addr}')
+        
+        payload, error = read_upload()
+        if error:
+            return error
+        
+        # Trúng cache thì trả kết quả ngay (200) thay vì tạo job
+        result = cached_result(payload)
+        if result:
+            return jsonify(dict(result, status='done'))
+        
+        job, error = admit_and_submit(payload, estimate_cost(payload['image_size'], payload['only_favicon']))
+        if error:
+            return error
         
         return jsonify({
             'success': True,
-            'download_url': f'/download/{os.path.basename(zip_path)}',
-            'is_single_file': False
-        })
+            'job_id': job.id,
+            'status_url': f'/jobs/{job.id}'
+        }), 202
         
     except Exception as e:
         return jsonify({'success': False, 'message': f'Lỗi xử lý: {str(e)}'}), 500
 
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    status = job_queue.status(job_id)
+    if status is None:
+        return jsonify({'success': False, 'message': 'Job không tồn tại'}), 404
+    return jsonify(status)
+
+# Nội dung artifact không bao giờ đổi dưới cùng một URL nên client / CDN được cache lâu dài
+ARTIFACT_MAX_AGE = 365 * 24 * 3600
+
+def send_artifact(path, name, download_name):
+    """send_file với ETag = hash nội dung: hỗ trợ If-None-Match (304) và Range (206)"""
+    # Flask hiểu đường dẫn tương đối theo thư mục của app chứ không theo thư mục làm việc (gunicorn --chdir)
+    response = send_file(os.path.abspath(path), as_attachment=True, download_name=download_name, conditional=True,
+                         etag=artifact_etag(name), max_age=ARTIFACT_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
 @app.route('/download/<filename>')
 def download_file(filename):
     try:
-        file_path = os.path.join('temp', filename)
+        file_path = os.path.join(TEMP_DIR, filename)
         if not os.path.exists(file_path):
             return "File không tồn tại", 404
         
-        def remove_file(response):
-            try:
-                os.remove(file_path)
-            except:
-                pass
-            return response
-        
-        return send_file(file_path, as_attachment=True, download_name=filename)
+        # File được giữ đến khi client gọi /cleanup hoặc artifact store dọn theo TTL/quota
+        return send_artifact(file_path, filename, filename)
     except Exception as e:
         return f"Lỗi tải file: {str(e)}", 500
 
@@ -452,37 +1556,96 @@ def download_file(filename):
 def download_direct(file_id, file_type):
     try:
         if file_type == 'favicon':
-            temp_path = os.path.join('temp', file_id)
+            temp_path = os.path.join(TEMP_DIR, file_id)
             favicon_path = os.path.join(temp_path, 'favicon.ico')
             
             if not os.path.exists(favicon_path):
                 return "File không tồn tại", 404
             
-            return send_file(favicon_path, as_attachment=True, download_name='favicon.ico')
+            return send_artifact(favicon_path, file_id, 'favicon.ico')
         
         return "Loại file không hỗ trợ", 404
     except Exception as e:
         return f"Lỗi tải file: {str(e)}", 500
 
+@app.route('/targets')
+def target_plans():
+    # Profile được chọn và số task encode thực sự của từng generation_type
+    return jsonify({
+        generation_type: icon_targets.plan_for(generation_type).summary()
+        for generation_type in icon_targets.sets
+    })
+
+@app.route('/admission/stats')
+def admission_stats():
+    stats = admission.stats()
+    # Ngân sách bộ nhớ là của worker trả lời request này
+    stats['memory'] = memory_budget.stats()
+    return jsonify(stats)
+
+@app.route('/cache/stats')
+def cache_stats():
+    return jsonify(result_cache.stats())
+
+@app.route('/artifacts/stats')
+def artifact_stats():
+    return jsonify(artifact_store.stats())
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # Các giá trị chỉ tính khi có người scrape
+    cache = result_cache.stats()
+    artifacts = artifact_store.stats()
+    control = admission.stats()
+    extra = [
+        ('favicon_admission_total', {'result': 'admitted'}, control['admitted']),
+        ('favicon_admission_total', {'result': 'queued'}, control['queued']),
+        ('favicon_admission_inflight_cost', {}, control['inflight_cost']),
+        ('favicon_admission_budget', {}, control['budget']),
+        ('favicon_temp_bytes', {}, path_size(TEMP_DIR)),
+        ('favicon_artifacts', {}, artifacts['artifacts']),
+        ('favicon_artifact_bytes', {}, artifacts['bytes']),
+        ('favicon_artifact_quota_bytes', {}, artifacts['max_bytes']),
+        ('favicon_artifacts_expired_total', {}, artifacts['expired']),
+        ('favicon_artifacts_evicted_total', {}, artifacts['evicted']),
+        ('favicon_result_cache_hits_total', {}, cache['hits']),
+        ('favicon_result_cache_misses_total', {}, cache['misses']),
+        ('favicon_ready', {}, int(readiness.ready)),
+    ] + [
+        (name, {}, value) for name, value in (
+            ('favicon_startup_seconds', readiness.startup_seconds),
+            ('favicon_warmup_seconds', readiness.warmup_seconds),
+        ) if value is not None
+    ] + [
+        ('favicon_admission_rejected_total', {'reason': reason}, count)
+        for reason, count in control['rejected'].items()
+    ]
+    return Response(metrics.render(extra), mimetype='text/plain; version=0.0.4')
+
 @app.route('/cleanup/<file_id>', methods=['DELETE'])
 def cleanup(file_id):
     try:
-        # Kiểm tra nếu là file ZIP
-        if file_id.endswith('.zip'):
-            # Chỉ cần xóa file ZIP (thư mục temp đã bị xóa khi tạo ZIP)
-            zip_path = os.path.join('temp', file_id)
-            if os.path.exists(zip_path):
-                os.remove(zip_path)
-        else:
-            # Xóa thư mục (cho trường hợp favicon only)
-            temp_path = os.path.join('temp', file_id)
-            if os.path.exists(temp_path):
-                cleanup_directory(temp_path)
+        # Không cho phép xóa các thư mục nội bộ (ví dụ temp/.cache)
+        if file_id.startswith('.'):
+            return jsonify({'success': False, 'message': 'File không hợp lệ'}), 400
+        
+        # File ZIP hoặc thư mục favicon-only: trả lease của request, xóa khi không còn lease nào.
+        # Client cũ gọi không kèm lease: trả một lease của artifact và luôn thành công như trước
+        lease = request.args.get('lease')
+        if not artifact_store.release(file_id, lease) and lease is not None:
+            return jsonify({'success': False, 'message': 'Lease không tồn tại hoặc đã được trả'}), 404
         
         return jsonify({'success': True, 'message': 'Đã dọn dẹp thành công!'})
     except Exception as e:
         return jsonify({'success': True, 'message': 'Đã dọn dẹp thành công!'})
 
+# Warm-up lúc import khi chạy dưới gunicorn (với --preload: một lần trong master, worker kế thừa),
+# CLI / benchmark import app thì bỏ qua trừ khi WARMUP=on
+if 'gunicorn' in sys.modules or app.config['WARMUP'] == 'on':
+    warm_start()
+
 if __name__ == '__main__':
+    if not readiness.ready:
+        warm_start()
     port = int(os.environ.get('PORT', 5000))
     app.run(debug=False, host='0.0.0.0', port=port)
\ No newline at end of file
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+"""
+Benchmark cho pipeline tạo icon
+- suite: thời gian từng stage trên bộ ảnh mẫu cố định, lưu JSON và so sánh với baseline
+- workers: thời gian mỗi request theo số thread encode (ENCODE_WORKERS)
+- profiles: thời gian encode và dung lượng output theo profile encoder
+- quantize: thời gian quantize, dung lượng PNG và PSNR theo thuật toán quantize / dither
+"""
+
+import argparse
+import io
+import json
+import logging
+import math
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import PIL
+
+from PIL import Image, ImageChops, ImageDraw, ImageStat
+
+import app as favicon_app
+
+
+def make_sample_image(width=1600, height=1200, mode='RGBA', seed=0):
+    """Tạo ảnh tổng hợp cố định (deterministic) có chi tiết để resize/encode tốn CPU thật"""
+    img = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+
+    step = max(width // 40, 4)
+    for i in range(0, width, step):
+        color = ((i * 7 + seed * 31) % 256, (i * 3 + seed * 17) % 256, (255 - i) % 256, 255)
+        draw.line([(i, 0), (width - i, height)], fill=color, width=max(step // 8, 1))
+    draw.ellipse([width // 5, height // 8, width * 4 // 5, height * 7 // 8], fill=(220, 40, 60, 180))
+
+    return img if mode == 'RGBA' else img.convert(mode)
+
+
+def make_palette_image(width, height, seed=0):
+    """Ảnh mode P có màu trong suốt (giống GIF/PNG 8-bit có nền trong suốt)"""
+    img = make_sample_image(width, height, 'RGB', seed).quantize(255)
+    img.paste(255, (0, 0, width, height // 4))
+    img.info['transparency'] = 255
+    return img
+
+
+def encode_sample(img, fmt='PNG'):
+    """Encode ảnh mẫu thành bytes như file upload"""
+    buffer = io.BytesIO()
+    if fmt == 'JPEG':
+        img.save(buffer, format=fmt, quality=90)
+    elif 'transparency' in img.info:
+        img.save(buffer, format=fmt, transparency=img.info['transparency'])
+    else:
+        img.save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+# Bộ ảnh của suite: (tên, rộng, cao, mode, định dạng)
+SUITE_CASES = [
+    ('small-square-rgba-png', 256, 256, 'RGBA', 'PNG'),
+    ('small-square-rgb-jpeg', 300, 300, 'RGB', 'JPEG'),
+    ('small-wide-p-gif', 480, 200, 'P', 'GIF'),
+    ('large-square-rgba-png', 2048, 2048, 'RGBA', 'PNG'),
+    ('large-square-rgb-jpeg', 3000, 3000, 'RGB', 'JPEG'),
+    ('large-wide-rgb-jpeg', 4000, 1500, 'RGB', 'JPEG'),
+    ('large-wide-p-png', 2400, 1000, 'P', 'PNG'),
+    ('large-square-p-gif', 1600, 1600, 'P', 'GIF'),
+]
+
+GENERATION_TYPES = ['full_set', 'favicon_only']
+
+
+def make_suite_corpus():
+    """Bộ ảnh cố định cho suite: nhỏ/lớn, vuông/ngang, RGB/RGBA/P trong suốt, JPEG/PNG/GIF"""
+    corpus = {}
+    for seed, (name, width, height, mode, fmt) in enumerate(SUITE_CASES):
+        if mode == 'P':
+            img = make_palette_image(width, height, seed)
+        else:
+            img = make_sample_image(width, height, mode, seed)
+        corpus[name] = encode_sample(img, fmt)
+    return corpus
+
+
+def make_corpus():
+    """Bộ ảnh mẫu cố định: logo trong suốt, ảnh chụp nhiều nhiễu, ảnh ngang"""
+    photo = Image.effect_noise((1200, 1200), 48).convert('RGB')
+    photo.paste(make_sample_image(800, 800, 'RGB', seed=3), (200, 200))
+    return {
+        'logo-rgba': encode_sample(make_sample_image()),
+        'photo-jpeg': encode_sample(photo, 'JPEG'),
+        'wide-rgb': encode_sample(make_sample_image(2000, 600, 'RGB', seed=5)),
+    }
+
+
+def run_pipeline(data, only_favicon=False, maintain_dimensions=True, profile=None):
+    """Chạy pipeline giống /generate (không ZIP, không cache), trả về {đường dẫn: bytes}"""
+    with tempfile.TemporaryDirectory() as temp_path:
+        master = favicon_app.decode_master(data, maintain_dimensions)
+
+        plan = favicon_app.get_plan(only_favicon, maintain_dimensions)
+        pyramid = favicon_app.build_resize_pyramid(master, plan.sizes, maintain_dimensions)
+        favicon_app.write_icons(
+            favicon_app.render_plan(master, plan, maintain_dimensions, pyramid, profile=profile), temp_path)
+
+        outputs = {}
+        for root, dirs, files in os.walk(temp_path):
+            for file in files:
+                path = os.path.join(root, file)
+                with open(path, 'rb') as f:
+                    outputs[os.path.relpath(path, temp_path)] = f.read()
+        return outputs
+
+
+def time_stages(data, only_favicon, profile=None):
+    """Chạy pipeline như create_icon_set + ZIP, đo riêng từng stage (giây)"""
+    stages = {}
+
+    def timed(stage, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        stages[stage] = stages.get(stage, 0.0) + time.perf_counter() - start
+        return result
+
+    # Cùng đường decode với request (decode_source, rồi các bước của normalize_source),
+    # kiểm tra alpha và thêm nền trắng được tách khỏi stage normalize để đo riêng
+    img = timed('decode', favicon_app.decode_source, data)
+    img = timed('normalize', favicon_app.reduce_source, img)
+    if timed('has_transparency', favicon_app.has_transparency, img):
+        img = timed('add_white_background', favicon_app.add_white_background, img)
+    # Ảnh đã là RGB thì normalize_image chỉ còn resize về master
+    master = timed('normalize', favicon_app.normalize_image, img, True, True)
+    plan = favicon_app.get_plan(only_favicon)
+    pyramid = timed('resize', favicon_app.build_resize_pyramid, master, plan.sizes)
+
+    # Mỗi task chỉ encode một lần như render_plan, các file trùng dùng lại bytes
+    encoder = favicon_app.get_encoder_profile(profile)
+    quantizer = favicon_app.PaletteQuantizer(master)
+    encoded = {}
+    for task in plan.tasks:
+        if task.frames:
+            continue
+        quantized = encoder['quantize_min_size'] is not None and task.size >= encoder['quantize_min_size']
+        stage = 'quantize' if quantized else 'png_encode'
+        encoded[task] = timed(stage, favicon_app.encode_image, pyramid[task.size], task.size, profile, quantizer)
+    # ICO ghép sau cùng từ frame của pyramid và PNG cùng size đã encode
+    for task in plan.tasks:
+        if task.frames:
+            encoded[task] = timed('ico_encode', favicon_app.encode_ico, pyramid, task.frames, profile,
+                                  favicon_app.reusable_frames(encoded, task.fit, profile))
+    entries = [(filename, encoded[task]) for filename, task in plan.files] + plan.documents
+
+    if not only_favicon:
+        timed('zip', lambda: b''.join(favicon_app.stream_zip(entries, profile)))
+
+    stages['total'] = sum(stages.values())
+    return stages
+
+
+def run_suite(repeat, profile=None):
+    """
+    Chạy suite, trả về kết quả dạng dict có thể lưu JSON.
+    Mỗi stage lấy lần chạy nhanh nhất: nhiễu (scheduler, cache) chỉ làm chậm đi nên min ổn định hơn median.
+    """
+    favicon_app.app.config['ENCODE_WORKERS'] = 1
+    results = {}
+    for name, data in make_suite_corpus().items():
+        for generation_type in GENERATION_TYPES:
+            runs = [time_stages(data, generation_type == 'favicon_only', profile) for _ in range(repeat)]
+            results[f'{name}/{generation_type}'] = {
+                stage: min(run.get(stage, 0.0) for run in runs)
+                for stage in runs[0]
+            }
+
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'repeat': repeat,
+            'statistic': 'min',
+            'encoder_profile': profile or favicon_app.app.config['ENCODER_PROFILE'],
+            'resample_quality': favicon_app.app.config['RESAMPLE_QUALITY'],
+        },
+        'results': results,
+    }
+
+
+def print_suite(report):
+    stages = sorted({stage for result in report['results'].values() for stage in result} - {'total'})
+    header = f"{'case':<36}" + ''.join(f'{stage[:12]:>13}' for stage in stages) + f"{'total':>10}"
+    print(header)
+    for case, result in report['results'].items():
+        row = ''.join(f"{result[stage] * 1000:>11.1f}ms" if stage in result else f"{'-':>13}" for stage in stages)
+        print(f"{case:<36}{row}{result['total'] * 1000:>8.1f}ms")
+
+
+def compare_suite(report, baseline, threshold, min_delta):
+    """So sánh với baseline, trả về danh sách regression (case, stage, trước, sau)"""
+    regressions = []
+    for case, result in report['results'].items():
+        base = baseline['results'].get(case)
+        if base is None:
+            continue
+        for stage, seconds in result.items():
+            before = base.get(stage)
+            if before is None:
+                continue
+            if seconds > before * (1 + threshold) and seconds - before > min_delta:
+                regressions.append((case, stage, before, seconds))
+    return regressions
+
+
+def bench_workers(worker_counts, repeat):
+    """Đo wall-clock mỗi request full set theo số thread encode, kiểm tra output giống hệt tuần tự"""
+    data = encode_sample(make_sample_image())
+
+    favicon_app.app.config['ENCODE_WORKERS'] = 1
+    reference = run_pipeline(data)
+
+    print(f"{'workers':>8} {'best (s)':>10} {'mean (s)':>10} {'speedup':>8} {'identical':>10}")
+    baseline = None
+    for workers in worker_counts:
+        favicon_app.app.config['ENCODE_WORKERS'] = workers
+        timings = []
+        identical = True
+        for _ in range(repeat):
+            start = time.perf_counter()
+            outputs = run_pipeline(data)
+            timings.append(time.perf_counter() - start)
+            identical = identical and outputs == reference
+
+        best = min(timings)
+        baseline = baseline or best
+        print(f"{workers:>8} {best:>10.3f} {sum(timings) / len(timings):>10.3f} "
+              f"{baseline / best:>7.2f}x {str(identical):>10}")
+
+
+def bench_profiles(profiles, repeat):
+    """Bảng thời gian encode + ZIP và dung lượng output cho từng profile encoder trên bộ ảnh mẫu"""
+    favicon_app.app.config['ENCODE_WORKERS'] = 1
+    masters = {}
+    for name, data in make_corpus().items():
+        masters[name] = favicon_app.decode_master(data)
+
+    print(f"{'profile':>10} {'input':>12} {'encode (s)':>11} {'PNG bytes':>11} {'ZIP bytes':>11}")
+    for profile in profiles:
+        for name, master in masters.items():
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                entries = list(favicon_app.render_icon_set(master, profile=profile))
+                archive = b''.join(favicon_app.stream_zip(entries, profile))
+                timings.append(time.perf_counter() - start)
+
+            png_bytes = sum(len(data) for arcname, data in entries if arcname.endswith('.png'))
+            print(f"{profile:>10} {name:>12} {min(timings):>11.3f} {png_bytes:>11,} {len(archive):>11,}")
+
+
+def psnr(reference, img):
+    """PSNR (dB) của img so với ảnh gốc, inf nếu giống hệt"""
+    diff = ImageChops.difference(reference.convert('RGB'), img.convert('RGB'))
+    mse = sum(ImageStat.Stat(diff).sum2) / (3 * reference.width * reference.height)
+    return math.inf if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+
+
+def bench_quantizers(methods, dithers, repeat):
+    """
+    Với mỗi thuật toán / dither: thời gian tính palette trên master 1024, thời gian map một size nhỏ hơn
+    vào palette đã có (palette reuse), dung lượng PNG 1024 và PSNR so với master
+    """
+    masters = {}
+    for name, data in make_corpus().items():
+        masters[name] = favicon_app.decode_master(data)
+
+    print(f"{'method':>14} {'dither':>16} {'input':>12} {'palette (ms)':>13} {'remap (ms)':>11} "
+          f"{'PNG bytes':>11} {'PSNR (dB)':>10}")
+    for method in methods:
+        for dither in dithers:
+            for name, master in masters.items():
+                smaller = favicon_app.fit_image(master, 310)
+                palette_times, remap_times = [], []
+                for _ in range(repeat):
+                    quantizer = favicon_app.PaletteQuantizer(master, method, dither)
+                    start = time.perf_counter()
+                    quantized = quantizer.quantize(master)
+                    palette_times.append(time.perf_counter() - start)
+                    start = time.perf_counter()
+                    quantizer.quantize(smaller)
+                    remap_times.append(time.perf_counter() - start)
+
+                buffer = io.BytesIO()
+                quantized.save(buffer, format='PNG', optimize=True, compress_level=9)
+                print(f"{method:>14} {dither:>16} {name:>12} {min(palette_times) * 1000:>13.1f} "
+                      f"{min(remap_times) * 1000:>11.1f} {len(buffer.getvalue()):>11,} {psnr(master, quantized):>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark pipeline tạo favicon')
+    subparsers = parser.add_subparsers(dest='command')
+
+    suite = subparsers.add_parser('suite', help='Đo từng stage trên bộ ảnh mẫu (mặc định)')
+    suite.add_argument('--repeat', type=int, default=3, help='Số lần chạy mỗi case (lấy lần nhanh nhất, tối thiểu 3 khi --compare)')
+    suite.add_argument('--profile', help='Profile encoder (mặc định theo ENCODER_PROFILE)')
+    suite.add_argument('--output', help='Lưu kết quả ra file JSON')
+    suite.add_argument('--compare', metavar='BASELINE', help='File JSON baseline để so sánh')
+    suite.add_argument('--threshold', type=float, default=0.15,
+                       help='Tỷ lệ chậm hơn baseline bị coi là regression (mặc định 0.15 = 15%%)')
+    suite.add_argument('--min-delta', type=float, default=0.01,
+                       help='Bỏ qua chênh lệch nhỏ hơn số giây này (nhiễu đo)')
+
+    workers = subparsers.add_parser('workers', help='Thời gian mỗi request theo số thread encode')
+    workers.add_argument('--workers', type=int, nargs='+',
+                         default=sorted({1, 2, 4, os.cpu_count() or 1}),
+                         help='Các giá trị ENCODE_WORKERS cần đo')
+    workers.add_argument('--repeat', type=int, default=3, help='Số lần chạy cho mỗi cấu hình')
+
+    profiles = subparsers.add_parser('profiles', help='Thời gian encode / dung lượng theo profile encoder')
+    profiles.add_argument('profiles', nargs='*', help='Các profile cần so sánh (mặc định tất cả)')
+    profiles.add_argument('--repeat', type=int, default=3, help='Số lần chạy cho mỗi cấu hình')
+
+    quantize = subparsers.add_parser('quantize', help='Thời gian / dung lượng / PSNR theo thuật toán quantize')
+    quantize.add_argument('methods', nargs='*', help='Các thuật toán cần so sánh (mặc định tất cả thuật toán khả dụng)')
+    quantize.add_argument('--dither', nargs='+', default=list(favicon_app.QUANTIZE_DITHERS),
+                          choices=list(favicon_app.QUANTIZE_DITHERS), help='Các kiểu dither cần đo')
+    quantize.add_argument('--repeat', type=int, default=3, help='Số lần chạy cho mỗi cấu hình')
+
+    # Không chỉ định lệnh thì chạy suite
+    argv = sys.argv[1:]
+    if not argv or argv[0] not in subparsers.choices and argv[0] not in ('-h', '--help'):
+        argv = ['suite'] + argv
+    args = parser.parse_args(argv)
+    if args.command == 'suite' and args.compare and args.repeat < 3:
+        parser.error('--compare cần --repeat >= 3 (một lần đo quá nhiễu để so sánh)')
+
+    # Tắt log INFO của app để không làm nhiễu kết quả
+    favicon_app.app.logger.setLevel(logging.WARNING)
+
+    print(f"🖥️  CPU cores: {os.cpu_count()}, Pillow {PIL.__version__}")
+    if args.command == 'workers':
+        bench_workers(args.workers, args.repeat)
+        return
+    if args.command == 'profiles':
+        bench_profiles(args.profiles or list(favicon_app.ENCODER_PROFILES), args.repeat)
+        return
+    if args.command == 'quantize':
+        bench_quantizers(args.methods or favicon_app.available_quantizers(), args.dither, args.repeat)
+        return
+
+    report = run_suite(args.repeat, args.profile)
+    print_suite(report)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"💾 Đã lưu kết quả: {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('meta', {}).get('statistic') != 'min':
+            print(f"⚠️  {args.compare} lưu median của mỗi stage, nên tạo lại baseline để so sánh min với min")
+        regressions = compare_suite(report, baseline, args.threshold, args.min_delta)
+        for case, stage, before, after in regressions:
+            print(f"❌ {case} {stage}: {before * 1000:.1f}ms -> {after * 1000:.1f}ms "
+                  f"(+{(after / before - 1) * 100:.0f}%)")
+        if regressions:
+            sys.exit(1)
+        print(f"✅ Không có regression so với {args.compare}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Tạo icon set offline cho thư mục / glob ảnh, không cần chạy Flask server
+Dùng đúng pipeline của /generate (create_icon_set), mỗi ảnh một thư mục hoặc một file ZIP.
+Manifest theo hash nội dung + tùy chọn trong thư mục output giúp bỏ qua ảnh không đổi giữa các lần chạy.
+
+    python cli.py logos/ --out build/icons --format zip --jobs 4
+    python cli.py 'tenants/**/logo.png' --out build/favicons --favicon-only
+"""
+
+import argparse
+import atexit
+import glob
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.utils import secure_filename
+
+# Import app tạo sẵn trạng thái của server (cache, hàng đợi, metrics...) trong TEMP_DIR: CLI không dùng tới
+# nên trỏ vào thư mục tạm riêng thay vì tạo temp/ trong thư mục đang đứng. Process con kế thừa biến môi trường.
+if 'TEMP_DIR' not in os.environ:
+    os.environ['TEMP_DIR'] = tempfile.mkdtemp(prefix='favicon-cli-')
+    atexit.register(shutil.rmtree, os.environ['TEMP_DIR'], ignore_errors=True)
+
+import app as favicon_app
+from storage import ResultCache, atomic_write
+
+MANIFEST_NAME = '.favicon-manifest.json'
+
+
+def find_inputs(patterns, exclude_dir=None):
+    """
+    Danh sách file ảnh (đã sắp xếp, không trùng) từ các thư mục, glob hoặc đường dẫn file.
+    Bỏ qua file nằm trong exclude_dir (thư mục output có thể nằm trong thư mục input).
+    """
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, dirs, files in os.walk(pattern):
+                dirs.sort()
+                paths.extend(os.path.join(root, file) for file in sorted(files))
+        elif glob.has_magic(pattern):
+            paths.extend(sorted(glob.glob(pattern, recursive=True)))
+        else:
+            paths.append(pattern)
+
+    exclude_dir = os.path.abspath(exclude_dir) + os.sep if exclude_dir else None
+    return list(dict.fromkeys(
+        os.path.normpath(path) for path in paths
+        if os.path.isfile(path) and favicon_app.allowed_file(os.path.basename(path))
+        and not (exclude_dir and os.path.abspath(path).startswith(exclude_dir))
+    ))
+
+
+def output_names(paths):
+    """Tên output cho từng ảnh theo tên file, thêm hậu tố nếu trùng (giống /batch)"""
+    names = {}
+    used_names = set()
+    for path in paths:
+        base = secure_filename(os.path.splitext(os.path.basename(path))[0]) or 'image'
+        name = base
+        index = 2
+        while name in used_names:
+            name = f'{base}-{index}'
+            index += 1
+        used_names.add(name)
+        names[path] = name
+    return names
+
+
+def output_path(out_dir, name, output_format, only_favicon):
+    if output_format == 'folder':
+        return os.path.join(out_dir, name)
+    return os.path.join(out_dir, f'{name}.ico' if only_favicon else f'{name}.zip')
+
+
+def load_manifest(out_dir):
+    try:
+        with open(os.path.join(out_dir, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_manifest(out_dir, manifest):
+    data = json.dumps(manifest, indent=2, sort_keys=True, ensure_ascii=False).encode('utf-8')
+    atomic_write(os.path.join(out_dir, MANIFEST_NAME), data)
+
+
+def build_one(item):
+    """
+    Tạo icon set cho một ảnh (chạy trong process con).
+    Output được tạo trong thư mục tạm rồi mới thay thế output cũ để lần chạy bị ngắt không để lại file dở.
+    """
+    start = time.perf_counter()
+    try:
+        with open(item['source'], 'rb') as f:
+            data = f.read()
+
+        with tempfile.TemporaryDirectory(dir=item['out_dir'], prefix='.build-') as work_dir:
+            icons_path = os.path.join(work_dir, 'icons')
+            favicon_app.create_icon_set(data, icons_path, item['maintain_dimensions'],
+                                        item['only_favicon'], profile=item['profile'])
+
+            if item['format'] == 'folder':
+                result_path = icons_path
+            elif item['only_favicon']:
+                result_path = os.path.join(icons_path, 'favicon.ico')
+            else:
+                result_path = favicon_app.zip_directory(icons_path, os.path.join(work_dir, 'icons.zip'),
+                                                        item['profile'])
+
+            if os.path.isdir(item['output']):
+                shutil.rmtree(item['output'])
+            os.replace(result_path, item['output'])
+
+        return {'source': item['source'], 'success': True, 'seconds': time.perf_counter() - start}
+    except Exception as e:
+        return {'source': item['source'], 'success': False, 'message': str(e)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tạo favicon / icon set offline cho nhiều ảnh')
+    parser.add_argument('inputs', nargs='+', help='Thư mục, glob (hỗ trợ **) hoặc file ảnh')
+    parser.add_argument('--out', required=True, help='Thư mục output')
+    parser.add_argument('--format', choices=['folder', 'zip'], default='folder',
+                        help='Mỗi ảnh một thư mục hoặc một file ZIP (favicon-only: file .ico)')
+    parser.add_argument('--favicon-only', action='store_true', help='Chỉ tạo favicon.ico')
+    parser.add_argument('--maintain-dimensions', action=argparse.BooleanOptionalAction, default=True,
+                        help='Giữ tỷ lệ ảnh với padding trắng (mặc định bật)')
+    parser.add_argument('--encoder-profile', choices=list(favicon_app.ENCODER_PROFILES),
+                        default=favicon_app.app.config['ENCODER_PROFILE'], help='Profile encoder PNG')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='Số ảnh xử lý song song')
+    parser.add_argument('--force', action='store_true', help='Tạo lại tất cả, bỏ qua manifest')
+    parser.add_argument('--verbose', action='store_true', help='Hiện log chi tiết của pipeline')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        favicon_app.app.logger.setLevel(logging.WARNING)
+    # Song song theo ảnh nên mỗi process chỉ cần một thread encode. Đặt cả biến môi trường vì process con
+    # khởi động bằng spawn / forkserver import lại app và đọc ENCODE_WORKERS từ môi trường
+    if args.jobs > 1:
+        os.environ['ENCODE_WORKERS'] = '1'
+        favicon_app.app.config['ENCODE_WORKERS'] = 1
+
+    os.makedirs(args.out, exist_ok=True)
+    paths = find_inputs(args.inputs, exclude_dir=args.out)
+    if not paths:
+        print('❌ Không tìm thấy ảnh nào')
+        sys.exit(1)
+
+    # Digest của bytes + các tùy chọn ảnh hưởng output (cùng key với result cache của server)
+    options = favicon_app.generation_options(args.maintain_dimensions, args.favicon_only, args.encoder_profile)
+    options['format'] = args.format
+    manifest = {} if args.force else load_manifest(args.out)
+    names = output_names(paths)
+
+    pending = []
+    skipped = 0
+    for path in paths:
+        with open(path, 'rb') as f:
+            digest = ResultCache.key_for(f.read(), options)
+        output = output_path(args.out, names[path], args.format, args.favicon_only)
+        entry = manifest.get(path)
+        if entry and entry['hash'] == digest and entry['output'] == output and os.path.exists(output):
+            skipped += 1
+            continue
+        pending.append({
+            'source': path, 'output': output, 'hash': digest, 'out_dir': args.out, 'format': args.format,
+            'maintain_dimensions': args.maintain_dimensions, 'only_favicon': args.favicon_only,
+            'profile': args.encoder_profile,
+        })
+
+    print(f"🖼️  {len(paths)} ảnh: {len(pending)} cần tạo, {skipped} không đổi")
+    start = time.perf_counter()
+    failed = 0
+    by_source = {item['source']: item for item in pending}
+    executor = None
+
+    try:
+        if args.jobs > 1 and len(pending) > 1:
+            executor = ProcessPoolExecutor(max_workers=args.jobs)
+            results = executor.map(build_one, pending, chunksize=max(1, len(pending) // (args.jobs * 8)))
+        else:
+            results = map(build_one, pending)
+
+        for done, result in enumerate(results, 1):
+            item = by_source[result['source']]
+            if result['success']:
+                manifest[item['source']] = {'hash': item['hash'], 'output': item['output']}
+                print(f"✅ [{done}/{len(pending)}] {item['source']} -> {item['output']} ({result['seconds']:.2f}s)")
+            else:
+                failed += 1
+                manifest.pop(item['source'], None)
+                print(f"❌ [{done}/{len(pending)}] {item['source']}: {result['message']}")
+    finally:
+        # Bị ngắt giữa chừng: bỏ các ảnh chưa bắt đầu, chờ ảnh đang chạy xong rồi đóng các process con
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        # Lưu cả khi bị ngắt để lần chạy sau không làm lại các ảnh đã xong
+        save_manifest(args.out, manifest)
+
+    print(f"🏁 Xong trong {time.perf_counter() - start:.1f}s: "
+          f"{len(pending) - failed} đã tạo, {skipped} bỏ qua, {failed} lỗi")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
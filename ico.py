@@ -0,0 +1,41 @@
+"""
+Ghi file ICO nhiều độ phân giải từ các frame đã render sẵn
+Frame nhỏ ghi dạng BMP 32-bit (mọi trình duyệt / Windows đều đọc được), frame lớn nhúng thẳng bytes PNG
+"""
+
+import struct
+
+# Kích thước lớn nhất một frame ICO được phép (byte width/height = 0 nghĩa là 256)
+MAX_ICO_SIZE = 256
+
+
+def bmp_frame(img):
+    """Frame BMP: DIB 32-bit BGRA xếp từ dưới lên + AND mask rỗng (trong suốt lấy từ alpha)"""
+    if img.mode != 'RGBA':
+        img = img.convert('RGBA')
+    width, height = img.size
+    # Encoder raw của Pillow: stride 0 (tự tính), ystep -1 = dòng dưới cùng trước
+    pixels = img.tobytes('raw', 'BGRA', 0, -1)
+    mask = bytes(((width + 31) // 32) * 4 * height)
+    # BITMAPINFOHEADER: chiều cao gấp đôi vì gồm cả XOR (pixel) và AND mask
+    header = struct.pack('<IiiHHIIiiII', 40, width, height * 2, 1, 32, 0, len(pixels) + len(mask), 0, 0, 0, 0)
+    return header + pixels + mask
+
+
+def build_ico(frames):
+    """frames: list (size, bytes của frame BMP hoặc PNG) -> bytes file ICO, frame xếp theo size tăng dần"""
+    frames = sorted(frames, key=lambda frame: frame[0])
+    for size, _ in frames:
+        if not 0 < size <= MAX_ICO_SIZE:
+            raise ValueError(f'Frame ICO không hợp lệ: {size}x{size}')
+
+    directory = []
+    offset = 6 + 16 * len(frames)
+    for size, data in frames:
+        dimension = size % MAX_ICO_SIZE
+        # ICONDIRENTRY: width, height, số màu palette, reserved, planes, bpp, dung lượng, offset
+        directory.append(struct.pack('<BBBBHHII', dimension, dimension, 0, 0, 1, 32, len(data), offset))
+        offset += len(data)
+
+    header = struct.pack('<HHH', 0, 1, len(frames))
+    return header + b''.join(directory) + b''.join(data for _, data in frames)
@@ -0,0 +1,162 @@
+"""
+Hàng đợi job bất đồng bộ cho việc tạo icon
+Hàng đợi và worker thread nằm trong từng process, trạng thái job được ghi ra
+file JSON để mọi worker Gunicorn đều trả lời được request polling
+"""
+
+import os
+import json
+import time
+import uuid
+import queue
+import logging
+import threading
+
+from storage import atomic_write
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """Hàng đợi đã đầy, client cần thử lại sau"""
+
+
+class Job:
+    """Một job tạo icon, theo dõi tiến độ (số icon đã xong / tổng)"""
+
+    # Khoảng thời gian tối thiểu giữa hai lần ghi tiến độ ra file
+    PERSIST_INTERVAL = 0.25
+
+    def __init__(self, job_queue, payload):
+        self.id = uuid.uuid4().hex[:16]
+        self.payload = payload
+        self.status = 'queued'
+        self.done = 0
+        self.total = 0
+        self.result = None
+        self.message = None
+        # HTTP status khi job lỗi: lỗi có thuộc tính status (413 / 503...) giữ nguyên, còn lại 500
+        self.error_status = None
+        self.created = time.time()
+        self._queue = job_queue
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+        self._persisted_at = 0
+
+    def set_total(self, total):
+        self.total = total
+        self.persist()
+
+    def advance(self, count=1):
+        """Gọi sau mỗi icon hoàn thành (có thể từ nhiều thread encode)"""
+        with self._lock:
+            self.done += count
+            throttled = time.monotonic() - self._persisted_at < self.PERSIST_INTERVAL
+        if not throttled:
+            self.persist()
+
+    def wait(self, timeout=None):
+        return self._finished.wait(timeout)
+
+    def to_dict(self):
+        data = {
+            'job_id': self.id,
+            'status': self.status,
+            'progress': {'done': self.done, 'total': self.total},
+            'created': self.created,
+            'updated': time.time(),
+        }
+        if self.result is not None:
+            data.update(self.result)
+        if self.message is not None:
+            data['message'] = self.message
+        if self.error_status is not None:
+            data['error_status'] = self.error_status
+        return data
+
+    def persist(self):
+        with self._lock:
+            self._persisted_at = time.monotonic()
+            data = json.dumps(self.to_dict()).encode('utf-8')
+            atomic_write(self._queue.status_path(self.id), data)
+
+    def _finish(self, status, result=None, message=None, error_status=None):
+        self.status = status
+        self.result = result
+        self.message = message
+        self.error_status = error_status
+        if status == 'done':
+            self.done = self.total
+        self.persist()
+        self._finished.set()
+
+
+class JobQueue:
+    """
+    Hàng đợi có giới hạn được phục vụ bởi một nhóm worker thread.
+    runner(payload, job) chạy pipeline và trả về dict kết quả cho client.
+    """
+
+    def __init__(self, directory, runner, workers=2, maxsize=16):
+        self.directory = directory
+        self.runner = runner
+        self.workers = workers
+        self.maxsize = maxsize
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def status_path(self, job_id):
+        return os.path.join(self.directory, f'{job_id}.json')
+
+    def submit(self, payload):
+        """Đưa job vào hàng đợi, raise QueueFull nếu đã đầy"""
+        job_queue = self._ensure_started()
+        job = Job(self, payload)
+        try:
+            job_queue.put_nowait(job)
+        except queue.Full:
+            raise QueueFull()
+        job.persist()
+        return job
+
+    def status(self, job_id):
+        """Đọc trạng thái job từ file (job có thể thuộc worker khác)"""
+        if not all(c in '0123456789abcdef' for c in job_id):
+            return None
+        try:
+            with open(self.status_path(job_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def pending(self):
+        """Số job đang chờ trong hàng đợi của process này"""
+        return self._queue.qsize() if self._queue is not None and self._pid == os.getpid() else 0
+
+    def _ensure_started(self):
+        # Thread không đi theo process con sau fork nên khởi động lười trong từng worker
+        with self._lock:
+            if self._queue is None or self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self.maxsize)
+                self._pid = os.getpid()
+                for i in range(self.workers):
+                    threading.Thread(target=self._work, args=(self._queue,),
+                                     name=f'job-worker-{i}', daemon=True).start()
+            return self._queue
+
+    def _work(self, job_queue):
+        while True:
+            job = job_queue.get()
+            try:
+                job.status = 'running'
+                job.persist()
+                result = self.runner(job.payload, job)
+                job._finish('done', result=result)
+            except Exception as e:
+                logger.error(f'Job {job.id} failed: {str(e)}')
+                job._finish('failed', message=str(e), error_status=getattr(e, 'status', 500))
+            finally:
+                job.payload = None
+                job_queue.task_done()
@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+"""
+Load test end-to-end qua HTTP
+Khởi động app bằng gunicorn (mặc định giống start.sh) trong một thư mục làm việc tạm, gửi hỗn hợp request
+/generate theo concurrency cố định hoặc theo tốc độ đến (req/s). Mỗi request thành công được theo sau bởi
+download và /cleanup như trình duyệt. Báo cáo p50/p95/p99, throughput, số lỗi / timeout và peak dung lượng temp/.
+
+    python loadtest.py --concurrency 4 --duration 60
+    python loadtest.py --rate 2 --duration 120 --mix favicon_only/small=3,full_set/large=1
+    python loadtest.py --workers 4 --worker-class gthread --threads 4 --env MEMORY_MODE=bounded --output run.json
+    python loadtest.py --compare run.json --threshold 0.2
+    python loadtest.py --url http://staging:5000 --concurrency 8 --requests 200
+"""
+
+import argparse
+import io
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageDraw
+
+from storage import path_size
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Ảnh upload theo tên: (rộng, cao, định dạng)
+IMAGES = {
+    'small': (256, 256, 'PNG'),
+    'large': (2048, 2048, 'PNG'),
+}
+
+GENERATION_TYPES = ('favicon_only', 'full_set')
+
+DEFAULT_MIX = 'favicon_only/small=4,full_set/small=3,favicon_only/large=1,full_set/large=2'
+
+PERCENTILES = (50, 95, 99)
+
+# Môi trường mặc định cho server tự khởi động
+SERVER_DEFAULT_ENV = {'ADMISSION_CLIENT_CONCURRENCY': '0', 'ADMISSION_RATE_LIMIT': '0'}
+
+
+def make_image(width, height, image_format):
+    """Logo tổng hợp cố định có nền trong suốt (PNG) để server chạy đủ nhánh xử lý alpha"""
+    img = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    step = max(width // 32, 4)
+    for i in range(0, width, step):
+        draw.line([(i, 0), (width - i, height)], fill=((i * 7) % 256, (i * 3) % 256, 255 - i % 256, 255),
+                  width=max(step // 6, 1))
+    draw.ellipse([width // 5, height // 6, width * 4 // 5, height * 5 // 6], fill=(220, 40, 60, 200))
+
+    buffer = io.BytesIO()
+    (img if image_format == 'PNG' else img.convert('RGB')).save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def parse_mix(text):
+    """'favicon_only/small=3,full_set/large=1' -> list (generation_type, image, trọng số)"""
+    mix = []
+    for part in text.split(','):
+        spec, _, weight = part.strip().partition('=')
+        generation_type, _, image = spec.partition('/')
+        if generation_type not in GENERATION_TYPES or image not in IMAGES:
+            raise ValueError(f'Scenario không hợp lệ: {part} (dạng <{"|".join(GENERATION_TYPES)}>/<{"|".join(IMAGES)}>=<trọng số>)')
+        mix.append((generation_type, image, float(weight or 1)))
+    return mix
+
+
+def percentile(values, p):
+    """Percentile theo nearest-rank (None nếu không có dữ liệu)"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(math.ceil(p / 100 * len(values)) - 1, 0))]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def multipart_body(fields, files):
+    """Body multipart/form-data (fields: {tên: giá trị}, files: {tên: (filename, bytes)})"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, data) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def is_timeout(error):
+    if isinstance(error, (socket.timeout, TimeoutError)):
+        return True
+    return isinstance(error, urllib.error.URLError) and isinstance(error.reason, (socket.timeout, TimeoutError))
+
+
+def request(method, url, timeout, data=None, content_type=None):
+    """Gửi request, trả về (status, body); lỗi HTTP trả về status của lỗi, lỗi mạng / timeout được raise"""
+    req = urllib.request.Request(url, data=data, method=method)
+    if content_type:
+        req.add_header('Content-Type', content_type)
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def run_flow(base_url, generation_type, image, data, timeout):
+    """
+    Một lượt của client: POST /generate -> GET download_url -> DELETE /cleanup.
+    Trả về dict kết quả với thời gian (giây) của từng bước.
+    """
+    result = {'scenario': f'{generation_type}/{image}', 'ok': False, 'timeout': False, 'status': None}
+    start = time.perf_counter()
+    try:
+        fields = {'generation_type': generation_type, 'maintain_dimensions': 'on'}
+        body, content_type = multipart_body(fields, {'image': (f'{image}.{IMAGES[image][2].lower()}', data)})
+        status, payload = request('POST', f'{base_url}/generate', timeout, body, content_type)
+        result['generate'] = time.perf_counter() - start
+        result['status'] = status
+        if status != 200:
+            return result
+
+        result_data = json.loads(payload)
+        download_url = result_data['download_url']
+        step = time.perf_counter()
+        status, content = request('GET', base_url + download_url, timeout)
+        result['download'] = time.perf_counter() - step
+        result['bytes'] = len(content)
+        if status != 200:
+            result['status'] = status
+            return result
+
+        step = time.perf_counter()
+        request('DELETE', base_url + result_data['cleanup_url'], timeout)
+        result['cleanup'] = time.perf_counter() - step
+        result['ok'] = True
+    except Exception as e:
+        result['timeout'] = is_timeout(e)
+        result['error'] = str(e)
+    finally:
+        result['total'] = time.perf_counter() - start
+    return result
+
+
+class DiskSampler:
+    """Thread lấy mẫu dung lượng temp/ định kỳ, giữ lại giá trị lớn nhất"""
+
+    def __init__(self, directory, interval=0.25):
+        self.directory = directory
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='disk-sampler', daemon=True)
+
+    def start(self):
+        if self.directory:
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        return self.peak if self.directory else None
+
+    def _run(self):
+        while not self._stop.is_set():
+            if os.path.isdir(self.directory):
+                self.peak = max(self.peak, path_size(self.directory))
+            self._stop.wait(self.interval)
+
+
+class Server:
+    """Gunicorn chạy app trong thư mục làm việc riêng (temp/ của lần chạy nằm trong đó)"""
+
+    def __init__(self, args):
+        self.args = args
+        self.port = free_port()
+        self.base_url = f'http://127.0.0.1:{self.port}'
+        self.workdir = tempfile.mkdtemp(prefix='favicon-loadtest-')
+        self.temp_dir = os.path.join(self.workdir, 'temp')
+        self.process = None
+        self.startup_seconds = None
+
+    def command(self):
+        args = self.args
+        command = [
+            sys.executable, '-m', 'gunicorn',
+            '--bind', f'127.0.0.1:{self.port}',
+            '--workers', str(args.workers),
+            '--worker-class', args.worker_class,
+            '--threads', str(args.threads),
+            '--worker-connections', '1000',
+            '--max-requests', str(args.max_requests),
+            '--max-requests-jitter', str(args.max_requests // 10),
+            '--timeout', str(args.server_timeout),
+            '--keep-alive', '2',
+            '--chdir', self.workdir,
+            '--pythonpath', REPO_DIR,
+            '--error-logfile', '-',
+            '--log-level', 'warning',
+        ]
+        if args.preload:
+            command.append('--preload')
+        return command + ['app:app']
+
+    def start(self):
+        env = dict(os.environ)
+        # Mọi client của load test dùng chung 127.0.0.1 nên bỏ giới hạn theo client (--env để ghi đè)
+        env.update(SERVER_DEFAULT_ENV)
+        for item in self.args.env:
+            key, _, value = item.partition('=')
+            env[key] = value
+
+        self.log = open(os.path.join(self.workdir, 'server.log'), 'wb')
+        start = time.perf_counter()
+        self.process = subprocess.Popen(self.command(), env=env, stdout=self.log, stderr=subprocess.STDOUT)
+
+        # Chờ /readyz (worker đã warm-up xong) thay vì chỉ chờ port mở
+        deadline = time.monotonic() + self.args.startup_timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'Server dừng khi khởi động, xem {self.log.name}')
+            try:
+                if request('GET', f'{self.base_url}/readyz', 2)[0] == 200:
+                    self.startup_seconds = time.perf_counter() - start
+                    return self
+            except OSError:
+                pass
+            time.sleep(0.1)
+        raise RuntimeError(f'Server không sẵn sàng sau {self.args.startup_timeout}s, xem {self.log.name}')
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        if self.process:
+            self.log.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class LoadGenerator:
+    """Sinh tải theo hỗn hợp scenario: closed-loop (concurrency) hoặc open-loop (rate, phân phối Poisson)"""
+
+    def __init__(self, base_url, mix, args):
+        self.base_url = base_url
+        self.mix = mix
+        self.args = args
+        self.results = []
+        self._lock = threading.Lock()
+        self._issued = 0
+        self._counter = 0
+        self._random = random.Random(args.seed)
+        self._images = {image: make_image(*IMAGES[image]) for image in {image for _, image, _ in mix}}
+
+    def next_request(self):
+        """Scenario kế tiếp và bytes upload, None khi đã đủ số request"""
+        with self._lock:
+            if self.args.requests and self._issued >= self.args.requests:
+                return None
+            self._issued += 1
+            self._counter += 1
+            generation_type, image, _ = self._random.choices(self.mix, weights=[w for _, _, w in self.mix])[0]
+            data = self._images[image]
+            if not self.args.cache_hits:
+                # Dữ liệu thừa sau cuối ảnh: decoder bỏ qua nhưng hash upload khác nên không trúng cache kết quả
+                data += f'loadtest-{self._counter}'.encode()
+            return generation_type, image, data
+
+    def record(self, result):
+        with self._lock:
+            self.results.append(result)
+
+    def run(self):
+        deadline = time.monotonic() + self.args.duration if self.args.duration else None
+        start = time.perf_counter()
+        if self.args.rate:
+            self._open_loop(deadline)
+        else:
+            self._closed_loop(deadline)
+        return time.perf_counter() - start
+
+    def _flow(self, generation_type, image, data, scheduled=None):
+        result = run_flow(self.base_url, generation_type, image, data, self.args.timeout)
+        if scheduled is not None:
+            # Open-loop: tính cả thời gian chờ phía client để không che mất độ trễ khi server quá tải
+            result['queued'] = time.perf_counter() - scheduled - result['total']
+            result['total'] += result['queued']
+        self.record(result)
+
+    def _closed_loop(self, deadline):
+        def client():
+            while deadline is None or time.monotonic() < deadline:
+                item = self.next_request()
+                if item is None:
+                    return
+                self._flow(*item)
+
+        threads = [threading.Thread(target=client, name=f'client-{i}') for i in range(self.args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _open_loop(self, deadline):
+        with ThreadPoolExecutor(max_workers=self.args.max_inflight, thread_name_prefix='client') as executor:
+            next_at = time.perf_counter()
+            while deadline is None or time.monotonic() < deadline:
+                item = self.next_request()
+                if item is None:
+                    break
+                delay = next_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(self._flow, *item, scheduled=next_at)
+                next_at += self._random.expovariate(self.args.rate)
+
+
+def summarize(results, elapsed):
+    """Thống kê theo scenario và tổng: số request, lỗi, timeout, percentile độ trễ (ms), throughput"""
+    groups = {}
+    for result in results:
+        groups.setdefault(result['scenario'], []).append(result)
+    groups = dict(sorted(groups.items()))
+    groups['all'] = results
+
+    summary = {}
+    for name, items in groups.items():
+        ok = [r for r in items if r['ok']]
+        statuses = {}
+        for r in items:
+            if not r['ok'] and r['status'] is not None:
+                statuses[str(r['status'])] = statuses.get(str(r['status']), 0) + 1
+        summary[name] = {
+            'requests': len(items),
+            'ok': len(ok),
+            'errors': sum(1 for r in items if not r['ok'] and not r['timeout']),
+            'timeouts': sum(1 for r in items if r['timeout']),
+            'error_statuses': statuses,
+            'throughput': len(ok) / elapsed if elapsed else 0.0,
+            'generate_ms': {f'p{p}': _ms(percentile([r['generate'] for r in ok], p)) for p in PERCENTILES},
+            'total_ms': {f'p{p}': _ms(percentile([r['total'] for r in ok], p)) for p in PERCENTILES},
+        }
+    return summary
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+def print_report(report):
+    config = report['config']
+    load = f"rate {config['rate']}/s" if config['rate'] else f"concurrency {config['concurrency']}"
+    print(f"⚙️  {config['target']} | {load} | {report['elapsed']:.1f}s")
+    if report.get('startup_seconds') is not None:
+        print(f"🚀 Server sẵn sàng sau {report['startup_seconds']:.2f}s")
+
+    header = f"{'scenario':<22} {'reqs':>5} {'ok':>5} {'err':>4} {'t/o':>4} {'req/s':>6} " \
+             + ' '.join(f"{f'p{p}':>8}" for p in PERCENTILES) + f" {'flow p95':>9}"
+    print(header)
+    print('-' * len(header))
+    for name, stats in report['summary'].items():
+        latencies = ' '.join(f"{_format_ms(stats['generate_ms'][f'p{p}']):>8}" for p in PERCENTILES)
+        print(f"{name:<22} {stats['requests']:>5} {stats['ok']:>5} {stats['errors']:>4} {stats['timeouts']:>4} "
+              f"{stats['throughput']:>6.2f} {latencies} {_format_ms(stats['total_ms']['p95']):>9}")
+
+    statuses = report['summary']['all']['error_statuses']
+    if statuses:
+        print('❗ HTTP lỗi: ' + ', '.join(f'{status} x{count}' for status, count in sorted(statuses.items())))
+    if report.get('peak_temp_bytes') is not None:
+        print(f"💽 Peak temp/: {report['peak_temp_bytes'] / (1024 * 1024):.1f} MB")
+    print('Độ trễ p50/p95/p99 là của /generate (ms), flow p95 gồm cả download và /cleanup')
+
+
+def _format_ms(value):
+    return '-' if value is None else f'{value:.0f}ms'
+
+
+def compare_reports(report, baseline, threshold):
+    """So sánh với baseline: regression khi p95 / p99 tăng, throughput giảm hoặc tỷ lệ lỗi tăng quá threshold"""
+    regressions = []
+    for name, stats in report['summary'].items():
+        base = baseline['summary'].get(name)
+        if base is None:
+            continue
+        for p in ('p95', 'p99'):
+            before, after = base['generate_ms'].get(p), stats['generate_ms'].get(p)
+            if before and after and after > before * (1 + threshold):
+                regressions.append((name, f'{p} latency', f'{before:.0f}ms', f'{after:.0f}ms'))
+        if base['throughput'] and stats['throughput'] < base['throughput'] * (1 - threshold):
+            regressions.append((name, 'throughput', f"{base['throughput']:.2f}/s", f"{stats['throughput']:.2f}/s"))
+        before_rate = (base['errors'] + base['timeouts']) / max(base['requests'], 1)
+        after_rate = (stats['errors'] + stats['timeouts']) / max(stats['requests'], 1)
+        if after_rate > before_rate + threshold / 10:
+            regressions.append((name, 'error rate', f'{before_rate:.1%}', f'{after_rate:.1%}'))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test HTTP end-to-end cho favicon generator')
+    parser.add_argument('--url', help='Chạy với server có sẵn thay vì tự khởi động gunicorn')
+    parser.add_argument('--temp-dir', help='Thư mục temp/ của server có sẵn (để đo peak dung lượng)')
+
+    load = parser.add_argument_group('tải')
+    load.add_argument('--mix', default=DEFAULT_MIX,
+                      help=f'Hỗn hợp scenario <generation_type>/<ảnh>=<trọng số> (mặc định {DEFAULT_MIX})')
+    load.add_argument('--concurrency', type=int, default=4, help='Số client chạy song song (closed-loop)')
+    load.add_argument('--rate', type=float, help='Tốc độ đến (req/s, open-loop Poisson) thay cho --concurrency')
+    load.add_argument('--max-inflight', type=int, default=256, help='Số request đang chờ tối đa khi dùng --rate')
+    load.add_argument('--duration', type=float, default=30, help='Thời gian chạy (giây, 0 = đến khi đủ --requests)')
+    load.add_argument('--requests', type=int, default=0, help='Tổng số request tối đa (0 = không giới hạn)')
+    load.add_argument('--timeout', type=float, default=60, help='Timeout phía client cho mỗi request (giây)')
+    load.add_argument('--cache-hits', action='store_true',
+                      help='Gửi lại đúng bytes ảnh (cho phép trúng cache kết quả), mặc định mỗi upload khác nhau')
+    load.add_argument('--seed', type=int, default=0, help='Seed chọn scenario (lặp lại được)')
+
+    server = parser.add_argument_group('server (mặc định giống start.sh)')
+    server.add_argument('--workers', type=int, default=2)
+    server.add_argument('--worker-class', default='sync')
+    server.add_argument('--threads', type=int, default=1)
+    server.add_argument('--server-timeout', type=int, default=30)
+    server.add_argument('--max-requests', type=int, default=1000)
+    server.add_argument('--no-preload', dest='preload', action='store_false')
+    server.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='Biến môi trường cho server, ví dụ --env MEMORY_MODE=bounded (lặp lại được)')
+    server.add_argument('--startup-timeout', type=float, default=60)
+
+    report_group = parser.add_argument_group('báo cáo')
+    report_group.add_argument('--output', help='Lưu báo cáo ra file JSON')
+    report_group.add_argument('--compare', metavar='BASELINE', help='File JSON baseline để so sánh')
+    report_group.add_argument('--threshold', type=float, default=0.2,
+                              help='Tỷ lệ xấu hơn baseline bị coi là regression (mặc định 0.2 = 20%%)')
+    args = parser.parse_args()
+
+    if not args.duration and not args.requests:
+        parser.error('Cần --duration hoặc --requests')
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    server = None
+    try:
+        if args.url:
+            base_url, temp_dir, target = args.url.rstrip('/'), args.temp_dir, args.url
+        else:
+            server = Server(args).start()
+            base_url, temp_dir = server.base_url, server.temp_dir
+            target = f"gunicorn {args.workers}x{args.worker_class}" \
+                     + (f" threads={args.threads}" if args.threads > 1 else '') \
+                     + (' ' + ' '.join(args.env) if args.env else '')
+
+        generator = LoadGenerator(base_url, mix, args)
+        sampler = DiskSampler(temp_dir).start()
+        elapsed = generator.run()
+        peak_temp = sampler.stop()
+    finally:
+        if server:
+            server.stop()
+
+    report = {
+        'config': {
+            'target': target,
+            'mix': args.mix,
+            'concurrency': args.concurrency,
+            'rate': args.rate,
+            'duration': args.duration,
+            'requests': args.requests,
+            'timeout': args.timeout,
+            'workers': args.workers,
+            'worker_class': args.worker_class,
+            'threads': args.threads,
+            'env': args.env,
+        },
+        'elapsed': elapsed,
+        'startup_seconds': server.startup_seconds if server else None,
+        'peak_temp_bytes': peak_temp,
+        'summary': summarize(generator.results, elapsed),
+    }
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"💾 Đã lưu kết quả: {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare_reports(report, baseline, args.threshold)
+        for name, metric, before, after in regressions:
+            print(f"❌ {name} {metric}: {before} -> {after}")
+        if regressions:
+            sys.exit(1)
+        print(f"✅ Không có regression so với {args.compare}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+"""
+Đo bộ nhớ theo request: RSS delta / peak RSS và peak allocation Python (tracemalloc) của từng stage
+Số liệu là của cả process nên chỉ chính xác khi worker chạy một request một lúc (JOB_WORKERS=1)
+Giới hạn bộ nhớ không dựa vào số đo: mỗi request giữ trước phần ước lượng từ header trong ngân sách của process
+"""
+
+import time
+import logging
+import threading
+import tracemalloc
+import contextvars
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('memory_tracker', default=None)
+
+# tracemalloc là trạng thái chung của process: bật khi request đầu tiên cần, tắt khi không còn ai dùng
+_trace_users = 0
+_trace_lock = threading.Lock()
+# Số request đang được đo: peak RSS chỉ được reset khi không có request nào khác đang đo
+_active_trackers = 0
+
+
+def _read_status(field):
+    """Giá trị (bytes) của một dòng trong /proc/self/status, None nếu không có (không phải Linux)"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def current_rss():
+    """RSS hiện tại của process (bytes), 0 nếu không đọc được"""
+    return _read_status('VmRSS') or 0
+
+
+def peak_rss():
+    """Peak RSS của process kể từ lần reset gần nhất (bytes), 0 nếu không đọc được"""
+    return _read_status('VmHWM') or 0
+
+
+def reset_peak_rss():
+    """Đặt lại peak RSS về RSS hiện tại (Linux >= 4.0), trả về False nếu không hỗ trợ"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class MemoryLimitExceeded(MemoryError):
+    """Request cần nhiều bộ nhớ hơn cả giới hạn của process (MEMORY_LIMIT_BYTES), không bao giờ chạy được"""
+
+    status = 413
+
+    def __init__(self, needed, limit):
+        super().__init__(f'Ảnh cần khoảng {needed // (1024 * 1024)}MB bộ nhớ, tối đa {limit // (1024 * 1024)}MB')
+        self.needed = needed
+        self.limit = limit
+
+
+class MemoryBudgetBusy(MemoryError):
+    """Các request khác trong process đang giữ ngân sách bộ nhớ, hết thời gian chờ"""
+
+    status = 503
+
+    def __init__(self, needed, available):
+        super().__init__(f'Máy chủ đang bận (cần {needed // (1024 * 1024)}MB bộ nhớ, '
+                         f'còn {available // (1024 * 1024)}MB), vui lòng thử lại sau')
+        self.needed = needed
+        self.available = available
+
+
+class MemoryBudget:
+    """
+    Ngân sách bộ nhớ của process (MEMORY_LIMIT_BYTES): mỗi lần generate giữ trước số bytes ước lượng
+    từ header trước khi decode và trả lại khi xong. Các request chạy đồng thời trong cùng worker
+    (JOB_WORKERS, /generate/stream) cộng dồn vào một ngân sách nên tổng ước lượng không vượt giới hạn.
+    """
+
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.reserved = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, nbytes, timeout=0):
+        """Chờ tối đa timeout giây đến khi đủ chỗ rồi giữ nbytes, trả về số bytes đã giữ (0 nếu tắt giới hạn)"""
+        if not self.limit:
+            return 0
+        if nbytes > self.limit:
+            raise MemoryLimitExceeded(nbytes, self.limit)
+
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self.reserved + nbytes > self.limit:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise MemoryBudgetBusy(nbytes, self.limit - self.reserved)
+                self._cond.wait(remaining)
+            self.reserved += nbytes
+        return nbytes
+
+    def release(self, nbytes):
+        if not nbytes:
+            return
+        with self._cond:
+            self.reserved -= nbytes
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {'limit': self.limit, 'reserved': self.reserved}
+
+
+class MemoryTracker:
+    """
+    Số liệu bộ nhớ của một request, theo stage:
+    - rss_delta: RSS sau stage trừ RSS trước stage
+    - rss_peak: peak RSS trong stage trừ RSS lúc bắt đầu request (bộ đệm pixel của Pillow nằm ở đây).
+      Peak RSS là của cả process nên khi có request khác đang đo thì không reset, chỉ lấy RSS cuối stage
+    - traced_peak: peak allocation Python trong stage so với lúc bắt đầu request (chỉ khi trace=True)
+    Chỉ dùng cho log / metrics, không dùng để giới hạn bộ nhớ (xem MemoryBudget)
+    """
+
+    def __init__(self, trace=False):
+        self.trace = trace
+        self.stages = {}
+        self.peak = 0
+        self._lock = threading.Lock()
+        self._rss_base = current_rss()
+        self._traced_base = 0
+        self._tracing = False
+
+    def start(self):
+        global _trace_users, _active_trackers
+        with _trace_lock:
+            _active_trackers += 1
+            if self.trace:
+                if _trace_users == 0 and not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                _trace_users += 1
+                self._tracing = True
+        if self._tracing:
+            self._traced_base = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def stop(self):
+        global _trace_users, _active_trackers
+        with _trace_lock:
+            _active_trackers -= 1
+            if self._tracing:
+                _trace_users -= 1
+                if _trace_users == 0:
+                    tracemalloc.stop()
+                self._tracing = False
+
+    @contextmanager
+    def activate(self):
+        """Gắn tracker vào thread / context hiện tại (ví dụ thread encode của batch)"""
+        token = _current.set(self)
+        try:
+            yield self
+        finally:
+            _current.reset(token)
+
+    @contextmanager
+    def stage(self, name):
+        rss_before = current_rss()
+        with _trace_lock:
+            alone = _active_trackers == 1
+        has_peak = alone and reset_peak_rss()
+        if self._tracing:
+            tracemalloc.reset_peak()
+
+        yield
+
+        rss_after = current_rss()
+        record = {
+            'rss_delta': rss_after - rss_before,
+            'rss_peak': max((peak_rss() if has_peak else rss_after) - self._rss_base, 0),
+        }
+        if self._tracing:
+            record['traced_peak'] = max(tracemalloc.get_traced_memory()[1] - self._traced_base, 0)
+
+        used = max(record['rss_peak'], record.get('traced_peak', 0))
+        with self._lock:
+            # Stage lặp lại (ví dụ nhiều item của batch) giữ giá trị lớn nhất
+            previous = self.stages.get(name)
+            if previous:
+                record = {key: max(value, previous.get(key, 0)) for key, value in record.items()}
+            self.stages[name] = record
+            self.peak = max(self.peak, used)
+
+    def to_dict(self):
+        with self._lock:
+            return {'peak': self.peak, 'stages': dict(self.stages)}
+
+
+def current_tracker():
+    """Tracker của request đang chạy trong context hiện tại (None nếu không đo)"""
+    return _current.get()
+
+
+@contextmanager
+def tracking(trace=False):
+    """Tạo tracker cho một request và gắn vào context hiện tại trong suốt request"""
+    tracker = MemoryTracker(trace).start()
+    try:
+        with tracker.activate():
+            yield tracker
+    finally:
+        tracker.stop()
@@ -0,0 +1,197 @@
+"""
+Metrics dạng Prometheus cho nhiều worker Gunicorn
+Mỗi process giữ số liệu trong bộ nhớ và ghi định kỳ ra temp/.metrics/<pid>.json,
+endpoint /metrics cộng dồn file của mọi process khi có người scrape
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+
+from storage import JsonIndex, atomic_write, pid_alive
+
+logger = logging.getLogger(__name__)
+
+# Bucket mặc định cho histogram thời gian (giây)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Bucket cho histogram dung lượng (bytes)
+BYTES_BUCKETS = tuple(mb * 1024 * 1024 for mb in (1, 4, 16, 32, 64, 128, 256, 512, 1024, 2048))
+
+
+def _key(name, labels):
+    return json.dumps([name, sorted((labels or {}).items())])
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + list(extra or [])
+    if not items:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for k, v in items)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """
+    Counter, histogram và gauge theo process.
+    Ghi ra file tối đa mỗi flush_interval giây nên gần như không tốn chi phí khi không ai scrape.
+    """
+
+    def __init__(self, directory, flush_interval=1.0, buckets=DEFAULT_BUCKETS):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.buckets = tuple(buckets)
+        self.descriptions = {}
+        self._buckets_by_name = {}
+        self._state = self._empty_state()
+        self._pid = os.getpid()
+        self._flushed_at = 0.0
+        self._lock = threading.Lock()
+        # Số liệu của các worker đã chết được gộp vào đây để counter không bị giảm
+        self._archive = JsonIndex(os.path.join(directory, 'archive.json'), default=self._empty_state())
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def _empty_state():
+        return {'counters': {}, 'histograms': {}, 'gauges': {}}
+
+    def describe(self, name, metric_type, help_text, buckets=None):
+        self.descriptions[name] = (metric_type, help_text)
+        if buckets is not None:
+            self._buckets_by_name[name] = tuple(buckets)
+
+    def buckets_for(self, name):
+        return self._buckets_by_name.get(name, self.buckets)
+
+    def inc(self, name, labels=None, value=1):
+        with self._lock:
+            self._check_fork()
+            key = _key(name, labels)
+            self._state['counters'][key] = self._state['counters'].get(key, 0) + value
+        self._maybe_flush()
+
+    def observe(self, name, labels=None, value=0.0):
+        with self._lock:
+            self._check_fork()
+            key = _key(name, labels)
+            buckets = self.buckets_for(name)
+            histogram = self._state['histograms'].setdefault(
+                key, {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0})
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+        self._maybe_flush()
+
+    def gauge_add(self, name, labels=None, delta=1):
+        """Gauge chỉ tính cho process còn sống (ví dụ số job đang chạy)"""
+        with self._lock:
+            self._check_fork()
+            key = _key(name, labels)
+            self._state['gauges'][key] = self._state['gauges'].get(key, 0) + delta
+        self._maybe_flush()
+
+    def flush(self):
+        with self._lock:
+            self._check_fork()
+            data = json.dumps(self._state).encode('utf-8')
+            self._flushed_at = time.monotonic()
+        atomic_write(os.path.join(self.directory, f'{os.getpid()}.json'), data)
+
+    def collect(self):
+        """Cộng dồn số liệu của mọi process (process đã chết được gộp vào archive)"""
+        self.flush()
+        total = self._empty_state()
+
+        with self._archive.locked() as archive:
+            for filename in os.listdir(self.directory):
+                pid_text, ext = os.path.splitext(filename)
+                if ext != '.json' or not pid_text.isdigit():
+                    continue
+                pid = int(pid_text)
+                path = os.path.join(self.directory, filename)
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        state = json.load(f)
+                except (OSError, ValueError):
+                    continue
+
+                if pid_alive(pid):
+                    self._merge(total, state, gauges=True)
+                else:
+                    self._merge(archive, state, gauges=False)
+                    os.remove(path)
+
+            self._merge(total, archive, gauges=False)
+
+        return total
+
+    def render(self, extra=None):
+        """
+        Text exposition format.
+        extra: list (name, labels, value) tính lúc scrape (ví dụ dung lượng temp/)
+        """
+        state = self.collect()
+        families = {}
+
+        for key, value in state['counters'].items():
+            name, labels = json.loads(key)
+            families.setdefault(name, []).append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+
+        for key, value in state['gauges'].items():
+            name, labels = json.loads(key)
+            families.setdefault(name, []).append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+
+        for key, histogram in state['histograms'].items():
+            name, labels = json.loads(key)
+            lines = families.setdefault(name, [])
+            for bound, count in zip(self.buckets_for(name), histogram['buckets']):
+                lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {count}')
+            lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {histogram["count"]}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(histogram["sum"])}')
+            lines.append(f'{name}_count{_format_labels(labels)} {histogram["count"]}')
+
+        for name, labels, value in extra or []:
+            families.setdefault(name, []).append(
+                f'{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}')
+
+        output = []
+        for name in sorted(families):
+            metric_type, help_text = self.descriptions.get(name, ('untyped', name))
+            output.append(f'# HELP {name} {help_text}')
+            output.append(f'# TYPE {name} {metric_type}')
+            output.extend(families[name])
+        return '\n'.join(output) + '\n'
+
+    def _merge(self, target, source, gauges):
+        for key, value in source['counters'].items():
+            target['counters'][key] = target['counters'].get(key, 0) + value
+        for key, histogram in source['histograms'].items():
+            merged = target['histograms'].setdefault(
+                key, {'buckets': [0] * len(histogram['buckets']), 'sum': 0.0, 'count': 0})
+            merged['buckets'] = [a + b for a, b in zip(merged['buckets'], histogram['buckets'])]
+            merged['sum'] += histogram['sum']
+            merged['count'] += histogram['count']
+        if gauges:
+            for key, value in source['gauges'].items():
+                target['gauges'][key] = target['gauges'].get(key, 0) + value
+
+    def _check_fork(self):
+        # Process con sau fork không được kế thừa số liệu của master (tránh đếm trùng)
+        if self._pid != os.getpid():
+            self._state = self._empty_state()
+            self._pid = os.getpid()
+            self._flushed_at = 0.0
+
+    def _maybe_flush(self):
+        if time.monotonic() - self._flushed_at >= self.flush_interval:
+            try:
+                self.flush()
+            except OSError as e:
+                logger.warning(f'Không ghi được metrics: {str(e)}')
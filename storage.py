@@ -0,0 +1,369 @@
+"""
+Lưu trữ file dùng chung giữa các worker Gunicorn
+Index dạng JSON được khóa bằng flock và ghi bằng atomic rename
+"""
+
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows - chỉ chạy 1 process khi dev
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+def atomic_write(path, data):
+    """Ghi file bằng file tạm + os.replace để process khác không đọc phải file dở"""
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def link_or_copy(src, dst):
+    """Hard link nếu được (gần như không tốn I/O), nếu không thì copy"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def atomic_link(src, dst):
+    """link_or_copy src vào dst qua tên tạm duy nhất + os.replace, an toàn khi nhiều thread / process ghi cùng dst"""
+    fd, reserved = tempfile.mkstemp(dir=os.path.dirname(dst) or '.', prefix='.tmp-')
+    os.close(fd)
+    # os.link không ghi đè file có sẵn nên link vào tên dẫn xuất từ tên mkstemp đang giữ chỗ
+    tmp_path = reserved + '.link'
+    try:
+        link_or_copy(src, tmp_path)
+        os.replace(tmp_path, dst)
+    finally:
+        for path in (reserved, tmp_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def pid_alive(pid):
+    """Process còn sống không (dùng để bỏ dữ liệu của worker đã chết)"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def path_size(path):
+    """Dung lượng của file hoặc tổng dung lượng file trong thư mục (bytes)"""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            try:
+                total += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                pass
+    return total
+
+
+def remove_path(path):
+    """Xóa file hoặc thư mục, bỏ qua nếu không còn tồn tại"""
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class JsonIndex:
+    """Index JSON nhỏ dùng chung giữa các process, mọi thay đổi đều nằm trong khóa"""
+
+    def __init__(self, path, default=None):
+        self.path = path
+        self.lock_path = path + '.lock'
+        self.default = default or {}
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    @contextmanager
+    def locked(self):
+        """Khóa độc quyền, trả về dict index; dữ liệu được ghi lại khi thoát"""
+        with open(self.lock_path, 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                data = self.read()
+                yield data
+                atomic_write(self.path, json.dumps(data).encode('utf-8'))
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read(self):
+        """Đọc index không khóa (file luôn được thay thế nguyên khối)"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return json.loads(json.dumps(self.default))
+
+
+class ResultCache:
+    """
+    Cache kết quả theo nội dung: key = hash(bytes upload + tùy chọn)
+    Giới hạn theo tổng dung lượng, loại bỏ theo TTL rồi LRU
+    """
+
+    def __init__(self, directory, max_bytes, ttl):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.index = JsonIndex(os.path.join(directory, 'index.json'),
+                               default={'entries': {}, 'hits': 0, 'misses': 0})
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key_for(data, options):
+        """Digest của bytes upload và các tùy chọn tạo icon"""
+        digest = hashlib.sha256(data)
+        digest.update(json.dumps(options, sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Trả về đường dẫn artifact đã cache hoặc None"""
+        if not self.enabled:
+            return None
+
+        now = time.time()
+        with self.index.locked() as index:
+            entry = index['entries'].get(key)
+            path = os.path.join(self.directory, entry['file']) if entry else None
+
+            if entry and (now - entry['created'] > self.ttl or not os.path.exists(path)):
+                self._remove(index, key)
+                entry = None
+
+            if entry is None:
+                index['misses'] += 1
+                return None
+
+            entry['accessed'] = now
+            index['hits'] += 1
+            return path
+
+    def put(self, key, source_path):
+        """Lưu artifact vào cache rồi loại bỏ entry cũ nếu vượt dung lượng"""
+        if not self.enabled:
+            return None
+
+        size = os.path.getsize(source_path)
+        if size > self.max_bytes:
+            return None
+
+        filename = key + os.path.splitext(source_path)[1]
+        path = os.path.join(self.directory, filename)
+        atomic_link(source_path, path)
+
+        now = time.time()
+        with self.index.locked() as index:
+            index['entries'][key] = {'file': filename, 'size': size, 'created': now, 'accessed': now}
+            self._evict(index, now)
+
+        return path
+
+    def stats(self):
+        """Số liệu hit/miss và dung lượng hiện tại"""
+        index = self.index.read()
+        entries = index['entries'].values()
+        return {
+            'hits': index['hits'],
+            'misses': index['misses'],
+            'entries': len(entries),
+            'bytes': sum(entry['size'] for entry in entries),
+            'max_bytes': self.max_bytes,
+        }
+
+    def _evict(self, index, now):
+        entries = index['entries']
+        for key in [k for k, e in entries.items() if now - e['created'] > self.ttl]:
+            self._remove(index, key)
+
+        total = sum(entry['size'] for entry in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]['accessed']):
+            if total <= self.max_bytes:
+                break
+            total -= entries[key]['size']
+            self._remove(index, key)
+
+    def _remove(self, index, key):
+        entry = index['entries'].pop(key, None)
+        if entry:
+            try:
+                os.remove(os.path.join(self.directory, entry['file']))
+            except OSError:
+                pass
+            logger.info(f'Result cache evicted {key[:12]}')
+
+
+class ArtifactStore:
+    """
+    Quản lý vòng đời artifact trong temp/ (ZIP, thư mục favicon-only).
+    Ghi lại thời điểm tạo và dung lượng của từng artifact, xóa khi hết TTL
+    và xóa artifact cũ nhất trước khi tổng dung lượng vượt quota.
+    Artifact đặt tên theo nội dung có thể được nhiều request dùng chung: mỗi lần
+    publish cấp một lease riêng, release chỉ trả đúng lease đó (một lần),
+    artifact chỉ bị xóa khi mọi lease đã được trả (hoặc hết TTL / vượt quota).
+    """
+
+    def __init__(self, directory, ttl, max_bytes, reap_interval=60, sweep_dirs=()):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.reap_interval = reap_interval
+        self.sweep_dirs = list(sweep_dirs)
+        self.index = JsonIndex(os.path.join(directory, '.store', 'index.json'),
+                               default={'artifacts': {}, 'evicted': 0, 'expired': 0})
+        self._reaper_pid = None
+        self._reaper_lock = threading.Lock()
+
+    def publish(self, source_path, name, filename=None):
+        """
+        Link source_path vào directory/name (hoặc directory/name/filename) nếu chưa có rồi đăng ký.
+        Kiểm tra và link nằm trong khóa nên không xen vào giữa lúc release xóa cùng artifact.
+        Trả về lease id của request này (dùng để release).
+        """
+        target = os.path.join(self.directory, name, filename) if filename else os.path.join(self.directory, name)
+        with self.index.locked() as index:
+            if not os.path.exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                tmp_path = f'{target}.tmp-{os.getpid()}'
+                link_or_copy(source_path, tmp_path)
+                os.replace(tmp_path, target)
+            return self._register(index, name)
+
+    def release(self, name, lease=None):
+        """
+        Client đã tải xong: trả lease, xóa artifact khi không còn lease nào.
+        lease=None (client cũ không biết lease): trả lease cũ nhất của artifact.
+        Lease không tồn tại (đã trả rồi, hoặc của artifact khác) thì không làm gì và trả về False.
+        """
+        with self.index.locked() as index:
+            artifact = index['artifacts'].get(name)
+            leases = artifact.get('leases', []) if artifact else []
+            if lease is None and leases:
+                lease = leases[0]
+            if lease not in leases:
+                return False
+            artifact['leases'].remove(lease)
+            if not artifact['leases']:
+                index['artifacts'].pop(name)
+                remove_path(os.path.join(self.directory, name))
+            return True
+
+    def reap(self):
+        """Xóa artifact hết hạn, file mồ côi (không có trong index) quá TTL và áp quota"""
+        now = time.time()
+        with self.index.locked() as index:
+            artifacts = index['artifacts']
+            for name in [n for n, a in artifacts.items() if now - a['created'] > self.ttl]:
+                artifacts.pop(name)
+                remove_path(os.path.join(self.directory, name))
+                index['expired'] += 1
+
+            # File/thư mục không được đăng ký (request bị lỗi giữa chừng, worker bị kill...)
+            for name in os.listdir(self.directory):
+                if name.startswith('.') or name in artifacts:
+                    continue
+                path = os.path.join(self.directory, name)
+                if self._older_than_ttl(path, now):
+                    remove_path(path)
+                    index['expired'] += 1
+
+            self._enforce_quota(index)
+
+        # Các thư mục nội bộ chỉ cần dọn theo TTL (ví dụ trạng thái job)
+        for directory in self.sweep_dirs:
+            for name in os.listdir(directory) if os.path.isdir(directory) else []:
+                path = os.path.join(directory, name)
+                if self._older_than_ttl(path, now):
+                    remove_path(path)
+
+    def stats(self):
+        """Số artifact, tổng dung lượng và số lần đã dọn theo TTL/quota"""
+        index = self.index.read()
+        return {
+            'artifacts': len(index['artifacts']),
+            'bytes': sum(a['size'] for a in index['artifacts'].values()),
+            'max_bytes': self.max_bytes,
+            'ttl': self.ttl,
+            'expired': index['expired'],
+            'evicted': index['evicted'],
+        }
+
+    def start_reaper(self):
+        """Khởi động thread dọn dẹp định kỳ (một thread cho mỗi process, an toàn sau fork)"""
+        with self._reaper_lock:
+            if self._reaper_pid == os.getpid():
+                return
+            self._reaper_pid = os.getpid()
+            threading.Thread(target=self._reap_forever, name='artifact-reaper', daemon=True).start()
+
+    def _reap_forever(self):
+        while True:
+            time.sleep(self.reap_interval)
+            try:
+                self.reap()
+            except Exception as e:
+                logger.error(f'Lỗi khi dọn artifact: {str(e)}')
+
+    def _register(self, index, name):
+        artifact = index['artifacts'].get(name)
+        lease = uuid.uuid4().hex
+        leases = artifact.get('leases', []) + [lease] if artifact else [lease]
+        # TTL tính lại từ lần publish gần nhất để URL vừa trả về không hết hạn sớm
+        index['artifacts'][name] = {'created': time.time(), 'size': path_size(os.path.join(self.directory, name)),
+                                    'leases': leases}
+        self._enforce_quota(index, keep=name)
+        return lease
+
+    def _enforce_quota(self, index, keep=None):
+        artifacts = index['artifacts']
+        total = sum(a['size'] for a in artifacts.values())
+        for name in sorted(artifacts, key=lambda n: artifacts[n]['created']):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            total -= artifacts.pop(name)['size']
+            remove_path(os.path.join(self.directory, name))
+            index['evicted'] += 1
+            logger.info(f'Artifact evicted (quota): {name}')
+
+    def _older_than_ttl(self, path, now):
+        try:
+            return now - os.path.getmtime(path) > self.ttl
+        except OSError:
+            return False
@@ -0,0 +1,262 @@
+"""
+Khai báo các bộ icon theo nền tảng (profile) và planner cho pipeline
+Planner gộp mọi file có cùng (size, fit, encoding) thành một task encode duy nhất,
+bytes của task được dùng chung cho tất cả tên file
+"""
+
+import json
+import hashlib
+from collections import namedtuple
+
+from ico import MAX_ICO_SIZE
+
+# Mỗi profile gồm danh sách targets {file, size} và metadata tùy chọn cho manifest.json / browserconfig.xml.
+# Định dạng encode suy ra từ đuôi file (.png hoặc .ico). File .ico có thể khai báo sizes
+# (danh sách frame, tối đa 256) thay cho size để tạo ICO nhiều độ phân giải.
+BUILTIN_PROFILES = {
+    'web': {
+        'description': 'Favicon PNG cho trình duyệt',
+        'targets': [
+            {'file': 'favicon-16x16.png', 'size': 16},
+            {'file': 'favicon-32x32.png', 'size': 32},
+            {'file': 'favicon-96x96.png', 'size': 96},
+        ],
+    },
+    'android': {
+        'description': 'Icon Android và manifest.json',
+        'targets': [
+            {'file': 'android-icon-36x36.png', 'size': 36},
+            {'file': 'android-icon-48x48.png', 'size': 48},
+            {'file': 'android-icon-72x72.png', 'size': 72},
+            {'file': 'android-icon-96x96.png', 'size': 96},
+            {'file': 'android-icon-144x144.png', 'size': 144},
+            {'file': 'android-icon-192x192.png', 'size': 192},
+        ],
+        'manifest': {
+            'name': 'Generated App',
+            'icons': [
+                {'file': 'android-icon-36x36.png', 'density': '0.75'},
+                {'file': 'android-icon-48x48.png', 'density': '1.0'},
+                {'file': 'android-icon-72x72.png', 'density': '1.5'},
+                {'file': 'android-icon-96x96.png', 'density': '2.0'},
+                {'file': 'android-icon-144x144.png', 'density': '3.0'},
+                {'file': 'android-icon-192x192.png', 'density': '4.0'},
+            ],
+        },
+    },
+    'apple': {
+        'description': 'Apple Touch icons',
+        'targets': [
+            {'file': f'apple-icon-{size}x{size}.png', 'size': size}
+            for size in (40, 58, 60, 76, 80, 87, 114, 120, 128, 136, 144, 152, 167, 180, 192, 1024)
+        ],
+    },
+    'microsoft': {
+        'description': 'Tile Windows và browserconfig.xml',
+        'targets': [
+            {'file': 'ms-icon-70x70.png', 'size': 70},
+            {'file': 'ms-icon-144x144.png', 'size': 144},
+            {'file': 'ms-icon-150x150.png', 'size': 150},
+            {'file': 'ms-icon-310x310.png', 'size': 310},
+        ],
+        'browserconfig': {
+            'tiles': [
+                {'element': 'square70x70logo', 'file': 'ms-icon-70x70.png'},
+                {'element': 'square150x150logo', 'file': 'ms-icon-150x150.png'},
+                {'element': 'square310x310logo', 'file': 'ms-icon-310x310.png'},
+            ],
+            'tile_color': '#ffffff',
+        },
+    },
+    'favicon': {
+        'description': 'favicon.ico',
+        'targets': [
+            {'file': 'favicon.ico', 'sizes': [16, 24, 32, 48, 64, 128, 256]},
+        ],
+    },
+    'apple-folder': {
+        'description': 'Thư mục icons/ với tên đơn giản cho Apple',
+        'targets': [
+            {'file': f'icons/{size}x{size}.png', 'size': size}
+            for size in (48, 72, 96, 120, 144, 152, 167, 180, 192, 1024)
+        ],
+    },
+}
+
+# Profile được chọn cho từng generation_type, theo đúng thứ tự file trong output
+BUILTIN_SETS = {
+    'favicon_only': ['favicon'],
+    'full_set': ['web', 'android', 'apple', 'microsoft', 'favicon', 'apple-folder'],
+}
+
+ENCODINGS = {'.png': 'png', '.ico': 'ico'}
+
+# Một lần encode: mọi file có cùng task dùng chung bytes.
+# frames: các kích thước frame của ICO (size là frame lớn nhất), rỗng với PNG
+Task = namedtuple('Task', ['size', 'fit', 'encoding', 'frames'], defaults=((),))
+
+
+def encoding_for(filename):
+    for ext, encoding in ENCODINGS.items():
+        if filename.endswith(ext):
+            return encoding
+    raise ValueError(f'Không hỗ trợ định dạng của target {filename}')
+
+
+def target_sizes(target):
+    """Các kích thước của một target: sizes (ICO nhiều frame) hoặc [size]"""
+    return target['sizes'] if 'sizes' in target else [target.get('size')]
+
+
+def task_for(target, fit):
+    encoding = encoding_for(target['file'])
+    if encoding == 'ico':
+        frames = tuple(sorted(set(target_sizes(target))))
+        return Task(frames[-1], fit, encoding, frames)
+    return Task(target['size'], fit, encoding)
+
+
+class Plan:
+    """
+    Kết quả lập kế hoạch cho một tập profile:
+    files - list (filename, Task) theo thứ tự output
+    tasks - list Task không trùng lặp, theo thứ tự xuất hiện đầu tiên
+    documents - list (filename, bytes) cho manifest.json / browserconfig.xml
+    """
+
+    def __init__(self, profiles, files, documents, fingerprint):
+        self.profiles = profiles
+        self.files = files
+        self.documents = documents
+        self.fingerprint = fingerprint
+        self.tasks = list(dict.fromkeys(task for _, task in files))
+
+    @property
+    def sizes(self):
+        """Mọi kích thước cần resize, kể cả từng frame của ICO"""
+        return {size for task in self.tasks for size in (task.frames or (task.size,))}
+
+    def summary(self):
+        """Số file / số task encode thực sự - để kiểm tra khi thêm profile"""
+        return {
+            'profiles': self.profiles,
+            'files': len(self.files),
+            'documents': [filename for filename, _ in self.documents],
+            'tasks': len(self.tasks),
+            'deduplicated': len(self.files) - len(self.tasks),
+            'sizes': sorted(self.sizes),
+        }
+
+
+class IconTargets:
+    """Registry profile (built-in + custom từ file JSON) và planner"""
+
+    def __init__(self, profiles=None, sets=None):
+        self.profiles = dict(BUILTIN_PROFILES)
+        self.profiles.update(profiles or {})
+        self.sets = dict(BUILTIN_SETS)
+        self.sets.update(sets or {})
+        self._plans = {}
+
+        for name, profile in self.profiles.items():
+            for target in profile.get('targets', []):
+                encoding = encoding_for(target['file'])
+                sizes = target_sizes(target)
+                if not sizes or any(not isinstance(size, int) or size <= 0 for size in sizes):
+                    raise ValueError(f'Profile {name}: size không hợp lệ cho {target.get("file")}')
+                if 'sizes' in target and encoding != 'ico':
+                    raise ValueError(f'Profile {name}: sizes chỉ dùng cho file .ico ({target["file"]})')
+                if encoding == 'ico' and max(sizes) > MAX_ICO_SIZE:
+                    raise ValueError(f'Profile {name}: frame ICO tối đa {MAX_ICO_SIZE} ({target["file"]})')
+        for set_name, names in self.sets.items():
+            for name in names:
+                if name not in self.profiles:
+                    raise ValueError(f'Bộ {set_name}: không có profile {name}')
+
+    @classmethod
+    def load(cls, path=None):
+        """
+        Đọc profile custom từ file JSON dạng {"profiles": {...}, "sets": {...}},
+        profile trùng tên sẽ thay thế profile built-in
+        """
+        if not path:
+            return cls()
+        with open(path, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        return cls(config.get('profiles'), config.get('sets'))
+
+    def plan_for(self, generation_type, maintain_dimensions=True):
+        if generation_type not in self.sets:
+            raise ValueError(f'Generation type không hợp lệ: {generation_type}')
+        return self.plan(self.sets[generation_type], maintain_dimensions)
+
+    def plan(self, names, maintain_dimensions=True):
+        """Lập kế hoạch cho danh sách profile (kết quả được nhớ lại vì profile không đổi khi chạy)"""
+        key = (tuple(names), maintain_dimensions)
+        if key not in self._plans:
+            self._plans[key] = self._build_plan(list(names), maintain_dimensions)
+        return self._plans[key]
+
+    def _build_plan(self, names, maintain_dimensions):
+        fit = 'contain' if maintain_dimensions else 'stretch'
+        selected = [self.profiles[name] for name in names]
+
+        files = {}
+        for profile in selected:
+            for target in profile.get('targets', []):
+                # File trùng tên giữa các profile chỉ được tạo một lần
+                files.setdefault(target['file'], task_for(target, fit))
+
+        documents = []
+        manifest = self._build_manifest(selected, files)
+        if manifest is not None:
+            documents.append(('manifest.json', manifest.encode('utf-8')))
+        browserconfig = self._build_browserconfig(selected)
+        if browserconfig is not None:
+            documents.append(('browserconfig.xml', browserconfig.encode('utf-8')))
+
+        digest = hashlib.sha256(json.dumps(selected, sort_keys=True).encode('utf-8')).hexdigest()
+        return Plan(names, list(files.items()), documents, digest)
+
+    @staticmethod
+    def _build_manifest(selected, files):
+        specs = [profile['manifest'] for profile in selected if 'manifest' in profile]
+        if not specs:
+            return None
+
+        icons = []
+        for spec in specs:
+            for icon in spec.get('icons', []):
+                if icon['file'] not in files:
+                    raise ValueError(f"manifest: {icon['file']} không có trong targets")
+                size = files[icon['file']].size
+                entry = {'src': f"/{icon['file']}", 'sizes': f'{size}x{size}', 'type': 'image/png'}
+                if 'density' in icon:
+                    entry['density'] = icon['density']
+                icons.append(entry)
+
+        manifest = {'name': specs[0].get('name', 'Generated App'), 'icons': icons}
+        return json.dumps(manifest, indent=2, ensure_ascii=False)
+
+    @staticmethod
+    def _build_browserconfig(selected):
+        specs = [profile['browserconfig'] for profile in selected if 'browserconfig' in profile]
+        if not specs:
+            return None
+
+        lines = [
+            '<?xml version="1.0" encoding="utf-8"?>',
+            '<browserconfig>',
+            '    <msapplication>',
+            '        <tile>',
+        ]
+        for spec in specs:
+            for tile in spec.get('tiles', []):
+                lines.append(f'            <{tile["element"]} src="/{tile["file"]}"/>')
+        lines.append(f'            <TileColor>{specs[0].get("tile_color", "#ffffff")}</TileColor>')
+        lines += [
+            '        </tile>',
+            '    </msapplication>',
+            '</browserconfig>',
+        ]
+        return '\n'.join(lines)
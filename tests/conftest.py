@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# Import app tạo trạng thái của server trong TEMP_DIR: test dùng thư mục tạm riêng, không tạo temp/ trong repo
+os.environ.setdefault('TEMP_DIR', tempfile.mkdtemp(prefix='favicon-test-'))
+os.environ.setdefault('WARMUP', 'off')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
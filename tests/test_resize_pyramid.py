@@ -0,0 +1,82 @@
+"""
+So sánh pyramid exact / balanced / fast với đường resize trước khi có pyramid trên mọi kích thước của full set:
+giữ tỷ lệ thì copy + thumbnail() (reducing_gap mặc định của Pillow) rồi dán giữa canvas trắng, không giữ tỷ lệ thì resize().
+Sai khác tính trên thang 0-255 theo từng kênh: mean là trung bình lớn nhất của một kênh, max là pixel lệch nhiều nhất.
+"""
+
+import random
+
+import pytest
+from PIL import Image, ImageChops, ImageDraw, ImageStat
+
+import app
+
+MASTER_SIZE = app.MASTER_SIZE
+
+
+def noise_master():
+    """Nhiễu đều có seed: trường hợp xấu nhất cho box filter (nhiều tần số cao)"""
+    data = random.Random(0).randbytes(MASTER_SIZE * MASTER_SIZE * 3)
+    return Image.frombytes('RGB', (MASTER_SIZE, MASTER_SIZE), data)
+
+
+def logo_master():
+    """Logo điển hình: nền trắng, mảng màu phẳng và cạnh sắc"""
+    img = Image.new('RGB', (MASTER_SIZE, MASTER_SIZE), 'white')
+    draw = ImageDraw.Draw(img)
+    draw.ellipse((100, 100, 900, 900), fill=(200, 30, 30))
+    draw.rectangle((400, 200, 620, 820), fill=(20, 20, 160))
+    draw.line((0, 1023, 1023, 0), fill='black', width=3)
+    return img
+
+
+def baseline_fit(master, size, maintain_dimensions=True):
+    """Resize từng kích thước như trước khi có pyramid (create_icons_from_image bản gốc)"""
+    img = master.copy()
+    if not maintain_dimensions:
+        return img.resize((size, size), Image.Resampling.LANCZOS)
+    img.thumbnail((size, size), Image.Resampling.LANCZOS)
+    new_img = Image.new('RGB', (size, size), (255, 255, 255))
+    new_img.paste(img, ((size - img.width) // 2, (size - img.height) // 2))
+    return new_img
+
+
+# (giữ tỷ lệ, master, quality, mean tối đa, max tối đa)
+BOUNDS = [
+    (True, noise_master, 'exact', 4.5, 24),
+    (True, noise_master, 'balanced', 3.5, 20),
+    (True, noise_master, 'fast', 7.5, 40),
+    (True, logo_master, 'exact', 1.5, 14),
+    (True, logo_master, 'balanced', 1.0, 12),
+    (True, logo_master, 'fast', 4.0, 32),
+    # resize() không có reducing_gap nên exact giống hệt
+    (False, noise_master, 'exact', 0, 0),
+    (False, noise_master, 'balanced', 4.5, 24),
+    (False, noise_master, 'fast', 8.5, 56),
+    (False, logo_master, 'exact', 0, 0),
+    (False, logo_master, 'balanced', 1.5, 12),
+    (False, logo_master, 'fast', 4.0, 36),
+]
+
+
+def pixel_difference(expected, actual):
+    diff = ImageChops.difference(expected, actual)
+    mean = max(ImageStat.Stat(diff).mean)
+    peak = max(high for _, high in diff.getextrema())
+    return mean, peak
+
+
+@pytest.mark.parametrize('maintain_dimensions, make_master, quality, max_mean, max_peak', BOUNDS,
+                         ids=[f"{'fit' if k else 'stretch'}-{m.__name__}-{q}" for k, m, q, _, _ in BOUNDS])
+def test_pyramid_close_to_baseline(maintain_dimensions, make_master, quality, max_mean, max_peak):
+    master = make_master()
+    sizes = sorted(app.get_plan(only_favicon=False, maintain_dimensions=maintain_dimensions).sizes)
+    pyramid = app.build_resize_pyramid(master, sizes, maintain_dimensions, quality=quality)
+
+    assert sorted(pyramid) == sizes
+    for size in sizes:
+        expected = baseline_fit(master, size, maintain_dimensions)
+        assert pyramid[size].size == expected.size
+        mean, peak = pixel_difference(expected, pyramid[size])
+        assert mean <= max_mean, f'{size}px: mean {mean:.2f} > {max_mean}'
+        assert peak <= max_peak, f'{size}px: max {peak} > {max_peak}'
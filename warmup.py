@@ -0,0 +1,98 @@
+"""
+Khởi động nhanh cho worker
+- Chỉ nạp các plugin Pillow cần dùng (PNG, JPEG, GIF, ICO) thay vì để Pillow import toàn bộ plugin lúc chạy
+- Theo dõi trạng thái sẵn sàng (warm-up xong) và thời gian từ lúc process khởi động đến khi sẵn sàng
+"""
+
+import os
+import time
+import logging
+import importlib
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Plugin Pillow được nạp sẵn: ICO cần BMP và PNG để đọc / ghi frame
+PRELOAD_PLUGINS = ('PngImagePlugin', 'JpegImagePlugin', 'GifImagePlugin', 'BmpImagePlugin', 'IcoImagePlugin')
+
+
+def preload_codecs(plugins=PRELOAD_PLUGINS):
+    """
+    Import trước các plugin cần dùng. Khi định dạng đã được đăng ký, Image.open(formats=...) và
+    Image.save(format='ICO') không gọi Image.init() (import mọi plugin) ở request đầu tiên.
+    """
+    from PIL import Image
+
+    for name in plugins:
+        importlib.import_module(f'PIL.{name}')
+    return sorted(set(Image.OPEN) | set(Image.SAVE))
+
+
+def process_start_time():
+    """Thời điểm (epoch) process được tạo, đọc từ /proc (Linux); không đọc được thì lấy thời điểm hiện tại"""
+    try:
+        with open('/proc/self/stat', 'r') as f:
+            # Trường 22 (starttime) tính bằng clock tick từ lúc boot, bỏ qua tên process trong ngoặc
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/stat', 'r') as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith('btime'))
+        return boot_time + start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, StopIteration):
+        return time.time()
+
+
+class Readiness:
+    """
+    Trạng thái sẵn sàng của process: warm-up xong (hoặc lỗi) thì mới nhận traffic.
+    Với gunicorn --preload warm-up chạy một lần trong master, worker fork ra kế thừa trạng thái.
+    """
+
+    def __init__(self):
+        self.started = process_start_time()
+        self.ready_at = None
+        self.warmup_seconds = None
+        self.error = None
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.ready_at is not None
+
+    def run(self, warm_up):
+        """
+        Chạy warm_up một lần rồi đánh dấu sẵn sàng (thread khác gọi cùng lúc thì chờ).
+        Warm-up lỗi chỉ ghi log, process vẫn phục vụ bình thường.
+        """
+        with self._run_lock:
+            if self.ready:
+                return
+            start = time.perf_counter()
+            try:
+                warm_up()
+            except Exception as e:
+                self.error = str(e)
+                logger.error(f'Warm-up lỗi: {str(e)}')
+            self.warmup_seconds = time.perf_counter() - start
+            self.mark_ready()
+
+    def mark_ready(self):
+        with self._lock:
+            if self.ready_at is None:
+                self.ready_at = time.time()
+
+    @property
+    def startup_seconds(self):
+        """Thời gian từ lúc process khởi động đến khi sẵn sàng"""
+        return None if self.ready_at is None else self.ready_at - self.started
+
+    def to_dict(self):
+        data = {
+            'ready': self.ready,
+            'pid': os.getpid(),
+            'startup_seconds': self.startup_seconds,
+            'warmup_seconds': self.warmup_seconds,
+        }
+        if self.error:
+            data['warmup_error'] = self.error
+        return data